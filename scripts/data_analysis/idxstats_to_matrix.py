@@ -1,81 +1,471 @@
-import pandas as pd
-from pathlib import Path
-import re
-import argparse
-import sys 
-
-def parse_args():
-    parser = argparse.ArgumentParser(
-        description="Generate OTU tables and summary read counts from per-sample mapping stats files."
-    )
-    parser.add_argument(
-        "-i", "--input_folder",
-        type=str,
-        default="results/mapping_counts",
-        help="Folder containing *_stats.tsv files (default: results/mapping_counts)"
-    )
-    parser.add_argument(
-        "-o", "--output_folder",
-        type=str,
-        default="results/mapping_counts",
-        help="Folder to write output files (default: results/mapping_counts)"
-    )
-    return parser.parse_args()
-
-
-def main():
-    args = parse_args()
-    input_folder = Path(args.input_folder)
-    output_folder = Path(args.output_folder)
-    output_folder.mkdir(parents=True, exist_ok=True)
-
-    # -------------------------------- Find files -------------------------------- #
-    filenames = list(input_folder.glob("barcode*_stats.tsv"))
-    
-    barcode_list = [f.stem.split("_stats")[0] for f in filenames]
-    print(barcode_list)
-
-    if not barcode_list:
-        print(f"No files matched the regex pattern '{args.pattern}'")
-        sys.exit(1)
-
-    # ------------------------------- Read in data ------------------------------- #
-    dfs = []
-
-    for barcode in barcode_list:
-        current_file = output_folder / f"{barcode}_stats.tsv" 
-        temp_df = pd.read_csv(current_file, 
-                            sep = "\t", 
-                            names = ["taxon", "length", "mapped", "unmapped" ])
-        temp_df["sample"] = barcode
-        dfs.append(temp_df)
-
-    df = pd.concat(dfs, ignore_index=True)
-
-
-    # -------------------------------- Clean up df ------------------------------- #
-    df["taxon"] = df["taxon"].str.replace("*", "unassigned")
-
-
-    # -------------------------- Extract summary values -------------------------- #
-    # Total number of mapped reads per sample
-    total_mapped = df[["sample", "mapped"]].groupby("sample").sum()
-
-
-    # --------------------------- Generate count matrix -------------------------- #
-    otu_table = df.pivot_table(
-        index = "taxon",
-        columns = "sample",
-        values = "mapped", 
-        fill_value = 0
-    )
-
-
-    # ------------------------------- Write to file ------------------------------ #
-    total_mapped.to_csv(str(output_folder) + "/mapped_per_sample.tsv", sep = "\t", index = True)
-    otu_table.to_csv(str(output_folder) + "/otu_table.tsv", sep = "\t", index = True)
-
-    print(f"Finished! mapped_per_sample.tsv and otu_table.tsv written to {output_folder}")
-
-if __name__ == "__main__":
+import pandas as pd
+import numpy as np
+from pathlib import Path
+import re
+import argparse
+import gzip
+import os
+import struct
+import sys 
+import time
+from multiprocessing import Pool
+
+# Bin number of the BAI pseudo-bin that holds the mapped/unmapped read counts of a reference
+BAI_PSEUDO_BIN = 37450
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Generate OTU tables and summary read counts from per-sample mapping stats files."
+    )
+    parser.add_argument(
+        "-i", "--input_folder",
+        type=str,
+        default="results/mapping_counts",
+        help="Folder containing *_stats.tsv files (default: results/mapping_counts)"
+    )
+    parser.add_argument(
+        "-o", "--output_folder",
+        type=str,
+        default="results/mapping_counts",
+        help="Folder to write output files (default: results/mapping_counts)"
+    )
+    parser.add_argument(
+        "--sparse_format",
+        nargs="+",
+        choices=["mtx", "parquet", "npz", "h5"],
+        default=None,
+        help="Write the OTU table as a sparse matrix instead of a dense TSV: Matrix Market (mtx), "
+        "long-format Parquet (parquet), scipy NPZ (npz) and/or HDF5 (h5). Needs scipy (h5 also needs h5py)"
+    )
+    parser.add_argument(
+        "--from_index",
+        action="store_true",
+        help="Read the counts directly from the .bai/.csi index of every barcode*.bam in the input folder "
+        "instead of samtools idxstats outputs (no samtools needed)"
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of BAM indexes read in parallel with --from_index, also for new or changed files in --incremental/--watch mode (default: 1)"
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only read files that are new or changed since the last run and merge them into the "
+        "outputs. Per-file fingerprints and per-sample counts are kept in --state_dir (needs pyarrow)"
+    )
+    parser.add_argument(
+        "--state_dir",
+        type=str,
+        default=None,
+        help="Folder for the incremental state (default: <output_folder>/idxstats_state)"
+    )
+    parser.add_argument(
+        "--watch",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Keep polling the input folder every SECONDS and update the outputs when files are added "
+        "or change, e.g. during a live run (implies --incremental, stop with Ctrl+C)"
+    )
+    return parser.parse_args()
+
+
+def read_bam_references(bam_file):
+    """
+    Reference names and lengths from the BAM header. BAM is BGZF (concatenated gzip members),
+    so only the first blocks holding the header are decompressed.
+    """
+    with gzip.open(bam_file, "rb") as bam:
+        magic, l_text = struct.unpack("<4si", bam.read(8))
+        if magic != b"BAM\1":
+            raise ValueError(f"{bam_file} is not a BAM file")
+        bam.read(l_text)
+        (n_ref,) = struct.unpack("<i", bam.read(4))
+        names = []
+        lengths = []
+        for _ in range(n_ref):
+            (l_name,) = struct.unpack("<i", bam.read(4))
+            names.append(bam.read(l_name)[:-1].decode())
+            (l_ref,) = struct.unpack("<i", bam.read(4))
+            lengths.append(l_ref)
+
+    return names, lengths
+
+
+def read_index_counts(index_file):
+    """
+    Mapped and unmapped read counts per reference from a .bai or .csi index, taken from the
+    pseudo-bin every reference carries (its second chunk holds the two counts), plus the number
+    of unplaced unmapped reads stored at the end of the index.
+    """
+    data = Path(index_file).read_bytes()
+    if data[:4] == b"BAI\1":
+        offset = 4
+        pseudo_bin = BAI_PSEUDO_BIN
+        bin_header = struct.Struct("<Ii")
+        csi = False
+    else:
+        # CSI is BGZF compressed, its pseudo-bin number depends on the depth of the binning scheme
+        data = gzip.decompress(data)
+        if data[:4] != b"CSI\1":
+            raise ValueError(f"{index_file} is not a BAI or CSI index")
+        min_shift, depth, l_aux = struct.unpack_from("<iii", data, 4)
+        offset = 16 + l_aux
+        pseudo_bin = ((1 << ((depth + 1) * 3)) - 1) // 7 + 1
+        bin_header = struct.Struct("<IQi")
+        csi = True
+
+    (n_ref,) = struct.unpack_from("<i", data, offset)
+    offset += 4
+    mapped = np.zeros(n_ref, dtype=np.int64)
+    unmapped = np.zeros(n_ref, dtype=np.int64)
+
+    for ref in range(n_ref):
+        (n_bin,) = struct.unpack_from("<i", data, offset)
+        offset += 4
+        for _ in range(n_bin):
+            bin_fields = bin_header.unpack_from(data, offset)
+            bin_id, n_chunk = bin_fields[0], bin_fields[-1]
+            offset += bin_header.size
+            if bin_id == pseudo_bin:
+                mapped[ref], unmapped[ref] = struct.unpack_from("<QQ", data, offset + 16)
+            offset += 16 * n_chunk
+        if not csi:
+            # Skip the linear index
+            (n_intv,) = struct.unpack_from("<i", data, offset)
+            offset += 4 + 8 * n_intv
+
+    n_no_coor = struct.unpack_from("<Q", data, offset)[0] if offset + 8 <= len(data) else 0
+
+    return mapped, unmapped, n_no_coor
+
+
+def find_index(bam_file):
+    """
+    Index file of a BAM: <name>.bam.bai, <name>.bai or <name>.bam.csi.
+    """
+    candidates = [
+        Path(f"{bam_file}.bai"),
+        bam_file.with_suffix(".bai"),
+        Path(f"{bam_file}.csi"),
+    ]
+    for index_file in candidates:
+        if index_file.exists():
+            return index_file
+
+    raise FileNotFoundError(f"No .bai or .csi index found for {bam_file}")
+
+
+def index_stats(bam_file):
+    """
+    The samtools idxstats table of a BAM (reference, length, mapped, unmapped and a final "*" row
+    with the unplaced unmapped reads), built from the BAM header and index alone.
+    """
+    names, lengths = read_bam_references(bam_file)
+    mapped, unmapped, n_no_coor = read_index_counts(find_index(bam_file))
+    if len(mapped) != len(names):
+        raise ValueError(f"Index of {bam_file} does not match its header")
+
+    return pd.DataFrame({
+        "taxon": names + ["*"],
+        "length": lengths + [0],
+        "mapped": np.r_[mapped, 0],
+        "unmapped": np.r_[unmapped, n_no_coor],
+    })
+
+
+def long_to_sparse(df, row_col, col_col="sample", value_col="mapped"):
+    """
+    Accumulates a long count table as COO triplets and converts it to a CSR matrix
+    (rows: row_col, columns: col_col, both sorted). Duplicate entries are summed.
+    """
+    from scipy import sparse
+
+    rows, row_names = pd.factorize(df[row_col], sort=True)
+    cols, col_names = pd.factorize(df[col_col], sort=True)
+    matrix = sparse.coo_matrix(
+        (df[value_col].to_numpy(), (rows, cols)),
+        shape=(len(row_names), len(col_names)),
+    ).tocsr()
+
+    return matrix, pd.Index(row_names, name=row_col), pd.Index(col_names, name=col_col)
+
+
+def write_sparse_matrix(matrix, row_names, col_names, prefix, formats):
+    """
+    Writes a sparse count matrix as Matrix Market, long-format Parquet, NPZ and/or HDF5.
+    Row and column names are written next to it as <prefix>_rows.tsv and <prefix>_samples.tsv.
+    """
+    from scipy import io, sparse
+
+    prefix = str(prefix)
+    written = []
+    row_names.to_frame(index=False).to_csv(f"{prefix}_rows.tsv", sep = "\t", index = False)
+    col_names.to_frame(index=False).to_csv(f"{prefix}_samples.tsv", sep = "\t", index = False)
+
+    if "mtx" in formats:
+        io.mmwrite(f"{prefix}.mtx", matrix.tocoo(), field="integer")
+        written.append(f"{prefix}.mtx")
+
+    if "parquet" in formats:
+        coo = matrix.tocoo()
+        long_table = pd.DataFrame({
+            row_names.name: np.asarray(row_names)[coo.row],
+            col_names.name: np.asarray(col_names)[coo.col],
+            "mapped": coo.data,
+        })
+        long_table.to_parquet(f"{prefix}.parquet", index = False)
+        written.append(f"{prefix}.parquet")
+
+    if "npz" in formats:
+        sparse.save_npz(f"{prefix}.npz", matrix.tocsr())
+        written.append(f"{prefix}.npz")
+
+    if "h5" in formats:
+        import h5py
+
+        csr = matrix.tocsr()
+        with h5py.File(f"{prefix}.h5", "w") as h5:
+            h5.create_dataset("data", data=csr.data, compression="gzip")
+            h5.create_dataset("indices", data=csr.indices, compression="gzip")
+            h5.create_dataset("indptr", data=csr.indptr, compression="gzip")
+            h5.create_dataset("shape", data=csr.shape)
+            h5.create_dataset("rows", data=np.asarray(row_names).astype(str).astype(bytes))
+            h5.create_dataset("samples", data=np.asarray(col_names).astype(str).astype(bytes))
+        written.append(f"{prefix}.h5")
+
+    return written
+
+
+def find_files(input_folder, from_index):
+    """
+    The barcode*_stats.tsv (or barcode*.bam) files of the input folder and their sample names.
+    """
+    pattern = "barcode*.bam" if from_index else "barcode*_stats.tsv"
+    filenames = list(input_folder.glob(pattern))
+    barcode_list = [f.stem.split("_stats")[0] for f in filenames]
+    return filenames, barcode_list, pattern
+
+
+def read_stats_table(current_file, from_index):
+    """
+    The idxstats table of one sample, from a samtools idxstats output or a BAM index.
+    """
+    if from_index:
+        return index_stats(current_file)
+    return pd.read_csv(current_file, 
+                       sep = "\t", 
+                       names = ["taxon", "length", "mapped", "unmapped" ])
+
+
+def read_counts(filenames, barcode_list, from_index, threads=1, mapped_only=False):
+    """
+    Reads the idxstats tables of all files into one long table (taxon, length, mapped, unmapped, sample).
+    """
+    if from_index and threads > 1 and len(filenames) > 1:
+        # Counts come straight from the BAM indexes, one index per worker
+        with Pool(min(threads, len(filenames))) as pool:
+            stats_tables = pool.map(index_stats, filenames)
+    else:
+        stats_tables = (read_stats_table(current_file, from_index) for current_file in filenames)
+
+    dfs = []
+
+    for barcode, temp_df in zip(barcode_list, stats_tables):
+        temp_df["sample"] = barcode
+
+        # idxstats lists every reference, for the sparse table only keep non-zero counts
+        if mapped_only:
+            temp_df = temp_df[temp_df["mapped"] > 0]
+        dfs.append(temp_df)
+
+    df = pd.concat(dfs, ignore_index=True)
+
+    # -------------------------------- Clean up df ------------------------------- #
+    df["taxon"] = df["taxon"].str.replace("*", "unassigned")
+
+    return df
+
+
+def write_tables(df, output_folder, sparse_format=None):
+    """
+    Writes the mapped reads per sample and the taxon x sample OTU table (dense or sparse).
+    """
+    # -------------------------- Extract summary values -------------------------- #
+    # Total number of mapped reads per sample
+    total_mapped = df[["sample", "mapped"]].groupby("sample").sum()
+
+
+    # ---------------------- Generate and write count matrix --------------------- #
+    total_mapped.to_csv(str(output_folder) + "/mapped_per_sample.tsv", sep = "\t", index = True)
+
+    if sparse_format:
+        # COO triplets -> CSR, no dense taxon x sample pivot
+        otu_matrix, taxa, samples = long_to_sparse(df[df["mapped"] > 0], "taxon")
+        written = write_sparse_matrix(otu_matrix, taxa, samples, output_folder / "otu_table", sparse_format)
+        print(f"Finished! mapped_per_sample.tsv and {', '.join(Path(f).name for f in written)} written to {output_folder}")
+    else:
+        otu_table = df.pivot_table(
+            index = "taxon",
+            columns = "sample",
+            values = "mapped", 
+            fill_value = 0
+        )
+        otu_table.to_csv(str(output_folder) + "/otu_table.tsv", sep = "\t", index = True)
+
+        print(f"Finished! mapped_per_sample.tsv and otu_table.tsv written to {output_folder}")
+
+
+def file_fingerprints(filenames, barcode_list):
+    """
+    Size and modification time of every input file, a file is re-read when either changes.
+    """
+    stats = [os.stat(f) for f in filenames]
+    return pd.DataFrame({
+        "file": [str(f) for f in filenames],
+        "sample": barcode_list,
+        "size": [st.st_size for st in stats],
+        "mtime_ns": [st.st_mtime_ns for st in stats],
+    })
+
+
+def load_state(state_dir):
+    """
+    Fingerprints and long counts of the files merged so far, empty tables on the first run.
+    """
+    files_path = state_dir / "files.parquet"
+    counts_path = state_dir / "counts.parquet"
+    if files_path.exists() and counts_path.exists():
+        return pd.read_parquet(files_path), pd.read_parquet(counts_path)
+
+    return (
+        pd.DataFrame(columns = ["file", "sample", "size", "mtime_ns"]),
+        pd.DataFrame(columns = ["taxon", "length", "mapped", "unmapped", "sample"]),
+    )
+
+
+def save_state(state_dir, files, counts):
+    """
+    Writes the state through temporary files, so an interrupted run leaves the old state intact.
+    """
+    state_dir.mkdir(parents=True, exist_ok=True)
+    for name, table in (("counts", counts), ("files", files)):
+        tmp_path = state_dir / f"{name}.parquet.tmp"
+        table.to_parquet(tmp_path, index = False)
+        os.replace(tmp_path, state_dir / f"{name}.parquet")
+
+
+def read_changed_file(task):
+    """
+    Counts of one new or changed file for an incremental update, or the error if it cannot be read (yet).
+    """
+    current_file, barcode, from_index = task
+    try:
+        return read_counts([Path(current_file)], [barcode], from_index), None
+    except (pd.errors.EmptyDataError, ValueError, OSError, struct.error) as error:
+        return None, str(error)
+
+
+def incremental_update(input_folder, output_folder, state_dir, from_index, sparse_format=None, threads=1):
+    """
+    Reads only files that are new or changed since the last update, replaces the counts of their
+    samples in the state (samples whose file disappeared are dropped) and rewrites the outputs.
+    Returns False if nothing changed.
+    """
+    filenames, barcode_list, pattern = find_files(input_folder, from_index)
+    current = file_fingerprints(filenames, barcode_list)
+    state_files, state_counts = load_state(state_dir)
+
+    merged = current.merge(state_files, on = ["file", "sample"], how = "left", suffixes = ("", "_state"))
+    changed = merged[
+        (merged["size"] != merged["size_state"]) | (merged["mtime_ns"] != merged["mtime_ns_state"])
+    ]
+    removed = state_files[~state_files["file"].isin(current["file"])]
+
+    if changed.empty and removed.empty:
+        return False
+
+    # Parse the new/changed files (BAM indexes in parallel), a file that cannot be read yet
+    # (e.g. still being written) is skipped and picked up again by the next update
+    tasks = [(current_file, barcode, from_index) for current_file, barcode in zip(changed["file"], changed["sample"])]
+    if from_index and threads > 1 and len(tasks) > 1:
+        with Pool(min(threads, len(tasks))) as pool:
+            results = pool.map(read_changed_file, tasks)
+    else:
+        results = [read_changed_file(task) for task in tasks]
+
+    new_counts = []
+    parsed = []
+    for (current_file, _, _), (file_counts, error) in zip(tasks, results):
+        if error is not None:
+            print(f"Skipping {current_file} for now: {error}")
+            continue
+        new_counts.append(file_counts)
+        parsed.append(current_file)
+
+    replaced = set(changed["sample"][changed["file"].isin(parsed)]) | set(removed["sample"])
+    counts = pd.concat(
+        [state_counts[~state_counts["sample"].isin(replaced)], *new_counts], ignore_index = True
+    )
+    files = pd.concat(
+        [
+            state_files[
+                state_files["file"].isin(current["file"]) & ~state_files["file"].isin(parsed)
+            ],
+            current[current["file"].isin(parsed)],
+        ],
+        ignore_index = True,
+    )
+
+    save_state(state_dir, files, counts)
+    print(f"Merged {len(parsed)} new or changed file(s), dropped {len(removed)} removed file(s)")
+
+    if counts.empty:
+        print(f"No files matched the pattern '{pattern}' in {input_folder}")
+        return True
+
+    write_tables(counts, output_folder, sparse_format)
+    return True
+
+
+def main():
+    args = parse_args()
+    input_folder = Path(args.input_folder)
+    output_folder = Path(args.output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    # ---------------------- Incremental updates / watch mode --------------------- #
+    if args.incremental or args.watch:
+        state_dir = Path(args.state_dir) if args.state_dir else output_folder / "idxstats_state"
+        if not args.watch:
+            if not incremental_update(input_folder, output_folder, state_dir, args.from_index, args.sparse_format, args.threads):
+                print("No new or changed files, outputs are up to date")
+            return
+
+        print(f"Watching {input_folder} every {args.watch:g}s (Ctrl+C to stop)")
+        try:
+            while True:
+                incremental_update(input_folder, output_folder, state_dir, args.from_index, args.sparse_format, args.threads)
+                time.sleep(args.watch)
+        except KeyboardInterrupt:
+            print("Stopped watching")
+        return
+
+    # -------------------------------- Find files -------------------------------- #
+    filenames, barcode_list, pattern = find_files(input_folder, args.from_index)
+    print(barcode_list)
+
+    if not barcode_list:
+        print(f"No files matched the pattern '{pattern}' in {input_folder}")
+        sys.exit(1)
+
+    # ------------------------------- Read in data ------------------------------- #
+    df = read_counts(filenames, barcode_list, args.from_index, args.threads, bool(args.sparse_format))
+
+    write_tables(df, output_folder, args.sparse_format)
+
+
+if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -15,34 +15,76 @@ python scripts/insilico_pcr.py \
     --max_errors 2 \
     --min_len 100 \
     --max_len 2000
+
+Optionally (--score) every primer hit is scored on its binding site: mismatches are
+weighted by their distance to the primer 3' end and a nearest-neighbour Tm of the
+primer/site duplex is estimated (SantaLucia 1998 unified parameters). Hits can be
+filtered on these scores and all amplicons ranked in a separate table.
+
+The same primer matcher can also trim primers from amplicon reads (--reads). Reads are
+streamed from FASTA/FASTQ, primers are only searched near the read ends, reads are
+oriented fwd->rev and trimmed, and per-read primer hits are reported:
+
+python scripts/insilico_pcr.py \
+    --reads reads.fastq.gz \
+    --reads_out reads_trimmed.fastq \
+    --hit_stats primer_hits.tsv \
+    --fwd_primer AGAGTTTGATCMTGGCTCAG \
+    --rev_primer CGGTTACCTTGTTACGACTT \
+    --max_errors 3 \
+    --threads 8
 """
 
 import argparse
+import gzip
+from itertools import islice
+from multiprocessing import Pool
 from Bio import SeqIO
-from Bio.Seq import Seq 
+from Bio.Seq import Seq
+from Bio.SeqIO.FastaIO import SimpleFastaParser
+from Bio.SeqIO.QualityIO import FastqGeneralIterator
 import regex
+import numpy as np
 
 # --------------------- Argument parsing --------------------- #
-parser = argparse.ArgumentParser(
-    description="Simulate PCR amplicons from a template FASTA using forward and reverse primers."
-)
-parser.add_argument("--fasta", required=True, help="Input template FASTA file")
-parser.add_argument("--fasta_out", required=True, help="Output FASTA file for extracted amplicons")
-parser.add_argument("--fwd_primer", required=True, help="Forward primer sequence (IUPAC allowed)")
-parser.add_argument("--rev_primer", required=True, help="Reverse primer sequence (IUPAC allowed)")
-parser.add_argument("--max_errors", type=int, default=1, help="Maximum number of errors allowed in fuzzy primer matching")
-parser.add_argument("--min_len", type=int, default=100, help="Minimum amplicon length")
-parser.add_argument("--max_len", type=int, default=2000, help="Maximum amplicon length")
-
-args = parser.parse_args()
-
-fasta = args.fasta
-fasta_out = args.fasta_out
-fwd_primer = args.fwd_primer
-rev_primer = args.rev_primer
-max_errors = args.max_errors
-min_len = args.min_len
-max_len = args.max_len
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Simulate PCR amplicons from a template FASTA using forward and reverse primers, or trim primers from amplicon reads."
+    )
+    parser.add_argument("--fasta", help="Input template FASTA file")
+    parser.add_argument("--fasta_out", help="Output FASTA file for extracted amplicons")
+    parser.add_argument("--fwd_primer", required=True, help="Forward primer sequence (IUPAC allowed)")
+    parser.add_argument("--rev_primer", required=True, help="Reverse primer sequence (IUPAC allowed)")
+    parser.add_argument("--max_errors", type=int, default=1, help="Maximum number of errors allowed in fuzzy primer matching")
+    parser.add_argument("--min_len", type=int, default=100, help="Minimum amplicon length")
+    parser.add_argument("--max_len", type=int, default=2000, help="Maximum amplicon length")
+    parser.add_argument("--score", action="store_true", help="Score primer binding sites (3'-end weighted mismatch penalty and Tm estimate)")
+    parser.add_argument("--three_prime_window", type=int, default=5, help="Number of 3'-terminal primer bases with increased mismatch weight (default: 5)")
+    parser.add_argument("--three_prime_weight", type=float, default=4.0, help="Mismatch weight of the 3'-terminal base, decreasing linearly to 1 at the window border (default: 4)")
+    parser.add_argument("--max_penalty", type=float, default=None, help="Optional: discard primer hits with a higher mismatch penalty (implies --score)")
+    parser.add_argument("--min_tm", type=float, default=None, help="Optional: discard primer hits with a lower estimated Tm in degrees C (implies --score)")
+    parser.add_argument("--score_table", default=None, help="Optional: TSV with all amplicons ranked by primer penalty and Tm (implies --score)")
+
+    # Read trimming mode
+    parser.add_argument("--reads", help="Read trimming mode: input FASTA/FASTQ reads (optionally gzipped)")
+    parser.add_argument("--reads_out", help="Output file for oriented and primer-trimmed reads (same format as --reads)")
+    parser.add_argument("--hit_stats", default=None, help="Optional: TSV with the primer hits found per read")
+    parser.add_argument("--search_window", type=int, default=150, help="Number of bases at each read end searched for primers (default: 150)")
+    parser.add_argument("--require_both", action="store_true", help="Only keep reads in which both primers were found")
+    parser.add_argument("--threads", type=int, default=1, help="Number of worker processes for read trimming (default: 1)")
+    parser.add_argument("--batch_size", type=int, default=10000, help="Number of reads sent to a worker at once (default: 10000)")
+
+    args = parser.parse_args()
+
+    if args.reads:
+        if not args.reads_out:
+            parser.error("--reads requires --reads_out")
+    elif not (args.fasta and args.fasta_out):
+        parser.error("either --fasta and --fasta_out or --reads and --reads_out are required")
+
+    args.score = args.score or args.max_penalty is not None or args.min_tm is not None or args.score_table is not None
+
+    return args
 
 
 # --------------------- IUPAC mapping for ambiguous bases -------------------- #
@@ -53,170 +95,506 @@ IUPAC = {
     "H": "[ACT]", "V": "[ACG]", "N": "[ACGT]"
 }
 
+# ------------------ Base encodings and nearest-neighbour data ---------------- #
+# IUPAC bases as 4-bit masks (A=1, C=2, G=4, T=8), so a site base matches a primer base if the masks overlap
+BASE_MASK = np.zeros(256, dtype=np.uint8)
+for base, mask in {
+    "A": 1, "C": 2, "G": 4, "T": 8,
+    "R": 5, "Y": 10, "S": 6, "W": 9,
+    "K": 12, "M": 3, "B": 14, "D": 13,
+    "H": 11, "V": 7, "N": 15
+}.items():
+    BASE_MASK[ord(base)] = mask
+    BASE_MASK[ord(base.lower())] = mask
+
+# Complement of the 4-bit masks (A<->T, C<->G)
+COMPLEMENT_MASK = np.array(
+    [((m & 1) << 3) | ((m & 2) << 1) | ((m & 4) >> 1) | ((m & 8) >> 3) for m in range(16)], dtype=np.uint8
+)
+
+# Index (A=0, C=1, G=2, T=3) of unambiguous masks, -1 for anything else
+MASK_TO_INDEX = np.full(16, -1, dtype=np.int8)
+MASK_TO_INDEX[[1, 2, 4, 8]] = [0, 1, 2, 3]
+
+# SantaLucia (1998) unified nearest-neighbour parameters for 5'-XY-3' stacks: dH (kcal/mol), dS (cal/K/mol)
+NN_PARAMS = {
+    "AA": (-7.9, -22.2), "AC": (-8.4, -22.4), "AG": (-7.8, -21.0), "AT": (-7.2, -20.4),
+    "CA": (-8.5, -22.7), "CC": (-8.0, -19.9), "CG": (-10.6, -27.2), "CT": (-7.8, -21.0),
+    "GA": (-8.2, -22.2), "GC": (-9.8, -24.4), "GG": (-8.0, -19.9), "GT": (-8.4, -22.4),
+    "TA": (-7.2, -21.3), "TC": (-8.2, -22.2), "TG": (-8.5, -22.7), "TT": (-7.9, -22.2),
+}
+NN_DH = np.array([NN_PARAMS[a + b][0] for a in "ACGT" for b in "ACGT"])
+NN_DS = np.array([NN_PARAMS[a + b][1] for a in "ACGT" for b in "ACGT"])
+
+# Initiation with a terminal G/C or A/T pair, indexed by base index (A, C, G, T)
+INIT_DH = np.array([2.3, 0.1, 0.1, 2.3])
+INIT_DS = np.array([4.1, -2.8, -2.8, 4.1])
+
+NA_CONC = 0.05       # monovalent cation concentration (M)
+PRIMER_CONC = 250e-9  # primer concentration (M)
+GAS_CONSTANT = 1.987  # cal/K/mol
+
+EDGE_DISTANCE = 1500  # configurable if desired
+
+
 # ----------------------------- Define functions ----------------------------- #
 def iupac_to_regex(seq):
     """Convert IUPAC pattern to regex"""
     new_string = []
-    
+
     for base in seq:
         base = base.upper()
         if base not in IUPAC:
             raise KeyError(f"Invalid IUPAC base '{base}' in sequence '{seq}' ")
         new_string.append(IUPAC[base])
-        
+
     return "".join(new_string)
 
-def fuzzy_summary(match):
+def fuzzy_summary(fuzzy_counts):
     """Return summary of fuzzy match errors"""
-    subs, ins, dels = match.fuzzy_counts
-    total_errors = sum(match.fuzzy_counts)
+    subs, ins, dels = fuzzy_counts
+    total_errors = sum(fuzzy_counts)
     if total_errors == 0:
         return "exact match"
     else:
         return f"fuzzy match with {subs} substitutions, {ins} insertions, {dels} deletions (total errors: {total_errors})"
-    
-
-# ---------------------------- Read in Fasta file ---------------------------- #
-# use SeqIO.read when working with a single fasta
-# use SeqIO.parse when working with multiple sequences
-records = list(SeqIO.parse(fasta, "fasta")) 
-record_dict = {record.id: record for record in records}
-
-
-# ----------------------------- Deal with primers ---------------------------- #
-fwd_primer_regex = iupac_to_regex(fwd_primer)
-fwd_primer_rc_regex = iupac_to_regex(str(Seq(fwd_primer).reverse_complement()))
-rev_primer_regex = iupac_to_regex(rev_primer)
-rev_primer_rc_regex = iupac_to_regex(str(Seq(rev_primer).reverse_complement()))
-
 
-# --------------------- Find positions were primers match -------------------- #
-fwd_matches = []
-fwd_rc_matches = []
-rev_matches = []
-rev_rc_matches = []
-
-for record in records:
-    seq_string = str(record.seq).upper()
-    header_string = record.id
-
-    # Search all four orientations
-    fwd_hits = list(regex.finditer(f"({fwd_primer_regex}){{e<={max_errors}}}", seq_string, regex.IGNORECASE | regex.BESTMATCH ))
-    fwd_rc_hits = list(regex.finditer(f"({fwd_primer_rc_regex}){{e<={max_errors}}}", seq_string, regex.IGNORECASE | regex.BESTMATCH))
-    rev_hits = list(regex.finditer(f"({rev_primer_regex}){{e<={max_errors}}}", seq_string, regex.IGNORECASE | regex.BESTMATCH))
-    rev_rc_hits = list(regex.finditer(f"({rev_primer_rc_regex}){{e<={max_errors}}}", seq_string, regex.IGNORECASE | regex.BESTMATCH))
-
-    # Store matches with contig id
-    for m in fwd_hits:
-        fwd_matches.append((header_string, m))
-    for m in fwd_rc_hits:
-        fwd_rc_matches.append((header_string, m))
-    for m in rev_hits:
-        rev_matches.append((header_string, m))
-    for m in rev_rc_hits:
-        rev_rc_matches.append((header_string, m))
-
-
-# -------------------- Print information about mismatches -------------------- #
-print("\nForward primer matches:")
-for id, m in fwd_matches:
-    print(f"contig={id}  start={m.start()}, end={m.end()}, {fuzzy_summary(m)}")
-
-print("\nForward RC primer matches:")
-for id, m in fwd_rc_matches:
-    print(f"contig={id}  start={m.start()}, end={m.end()}, {fuzzy_summary(m)}")
-
-print("\nReverse primer matches:")
-for id, m in rev_matches:
-    print(f"contig={id}  start={m.start()}, end={m.end()}, {fuzzy_summary(m)}")
-
-print("\nReverse RC primer matches:")
-for id, m in rev_rc_matches:
-    print(f"contig={id}  start={m.start()}, end={m.end()}, {fuzzy_summary(m)}")
-
-
-
-# -------------------------- Find sensible amplicons ------------------------- #
-amplicons = []
-contigs_with_sensible = set()  # Track contigs with "normal" amplicons
-
-# fwd + rev_rc (original orientation)
-for f_contig_id, f in fwd_matches:
-    for r_contig_id, r in rev_rc_matches:
-        if f_contig_id == r_contig_id and r.start() > f.end():
-            length = r.end() - f.start()
-            if min_len <= length <= max_len:
-                amplicons.append((f_contig_id, f, r, length, "fwd+rev_rc"))
-                contigs_with_sensible.add(f_contig_id)
-
-# fwd_rc + rev (flipped orientation)
-for f_contig_id, f in fwd_rc_matches:
-    for r_contig_id, r in rev_matches:
-        if r_contig_id == f_contig_id and f.start() > r.end():
-            length = f.end() - r.start()
-            if min_len <= length <= max_len:
-                amplicons.append((f_contig_id, f, r, length, "fwd_rc+rev"))
-                contigs_with_sensible.add(f_contig_id)
-
-
-# ---------------------- Handle single-end edge cases ----------------------- #
-edge_distance = 1500  # configurable if desired
-
-for record in records:
-    contig_id = record.id
-    if contig_id in contigs_with_sensible:
-        continue  # Skip edge-case search for this contig
-
-    seq_len = len(record.seq)
+def compile_primer(primer_regex, max_errors):
+    """Compile a fuzzy primer regex once so it can be reused for every contig"""
+    return regex.compile(f"({primer_regex}){{e<={max_errors}}}", regex.IGNORECASE | regex.BESTMATCH)
+
+def compile_primers(fwd_primer, rev_primer, max_errors):
+    """Compile the four primer orientations (fwd, fwd_rc, rev, rev_rc)"""
+    return {
+        "Forward": compile_primer(iupac_to_regex(fwd_primer), max_errors),
+        "Forward RC": compile_primer(iupac_to_regex(str(Seq(fwd_primer).reverse_complement())), max_errors),
+        "Reverse": compile_primer(iupac_to_regex(rev_primer), max_errors),
+        "Reverse RC": compile_primer(iupac_to_regex(str(Seq(rev_primer).reverse_complement())), max_errors),
+    }
+
+def find_hits(pattern, seq_string):
+    """
+    Return primer hits as lightweight (start, end, fuzzy_counts) tuples.
+    The regex Match objects are dropped right away so they do not pin the contig sequence in memory.
+    """
+    return [(m.start(), m.end(), m.fuzzy_counts) for m in pattern.finditer(seq_string)]
+
+def binding_sites(seq_masks, hits, primer_len, on_minus_strand):
+    """
+    Collect the template bases under all primer hits as one (n_hits, primer_len) array of base masks,
+    written 5'->3' in primer orientation and anchored at the primer 3' end.
+    Hits on the minus strand are reverse complemented; positions outside the contig are 0 (never match).
+    """
+    starts = np.fromiter((h[0] for h in hits), dtype=np.int64, count=len(hits))
+    ends = np.fromiter((h[1] for h in hits), dtype=np.int64, count=len(hits))
+    offsets = np.arange(primer_len)
+
+    if on_minus_strand:
+        # primer 3' end sits at the hit start on the plus strand
+        positions = starts[:, None] + offsets[::-1]
+    else:
+        positions = ends[:, None] - primer_len + offsets
+
+    inside = (positions >= 0) & (positions < len(seq_masks))
+    sites = np.where(inside, seq_masks[np.clip(positions, 0, len(seq_masks) - 1)], 0).astype(np.uint8)
+
+    if on_minus_strand:
+        sites = COMPLEMENT_MASK[sites]
+
+    return sites
+
+def score_sites(primer, sites, three_prime_window, three_prime_weight):
+    """
+    Score all binding sites of one primer at once.
+    Returns the 3'-end weighted mismatch penalty and the nearest-neighbour Tm estimate per site.
+    """
+    primer_masks = BASE_MASK[np.frombuffer(primer.upper().encode(), dtype=np.uint8)]
+    primer_len = len(primer_masks)
+    matches = (sites & primer_masks) != 0
+
+    # Position weights: 1 along the primer, rising linearly to three_prime_weight at the 3'-terminal base
+    dist_to_3prime = np.arange(primer_len)[::-1]
+    window = max(three_prime_window, 1)
+    weights = np.where(
+        dist_to_3prime < window,
+        three_prime_weight - (three_prime_weight - 1) * dist_to_3prime / window,
+        1.0,
+    )
+    penalty = (~matches * weights).sum(axis=1)
+
+    # Nearest-neighbour Tm over the site sequence, only stacks with two matched, unambiguous pairs contribute
+    idx = MASK_TO_INDEX[sites]
+    paired = matches & (idx >= 0)
+    stacks = paired[:, :-1] & paired[:, 1:]
+    stack_idx = np.where(stacks, 4 * idx[:, :-1] + idx[:, 1:], 0)
+    dh = np.where(stacks, NN_DH[stack_idx], 0.0).sum(axis=1)
+    ds = np.where(stacks, NN_DS[stack_idx], 0.0).sum(axis=1)
+
+    # Initiation terms from the terminal site bases (treated as A/T when unpaired)
+    first = np.where(paired[:, 0], idx[:, 0], 0)
+    last = np.where(paired[:, -1], idx[:, -1], 0)
+    dh = dh + INIT_DH[first] + INIT_DH[last]
+    ds = ds + INIT_DS[first] + INIT_DS[last]
+
+    # Salt correction on the entropy term (SantaLucia 1998)
+    ds = ds + 0.368 * (primer_len - 1) * np.log(NA_CONC)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        tm = dh * 1000 / (ds + GAS_CONSTANT * np.log(PRIMER_CONC / 4)) - 273.15
+
+    return penalty, tm
+
+def score_hits(seq_string, hits, args):
+    """
+    Attach (penalty, tm) to every primer hit of one contig and drop hits failing --max_penalty/--min_tm.
+    All hits of one primer orientation are scored together on NumPy arrays.
+    """
+    seq_masks = BASE_MASK[np.frombuffer(seq_string.encode(), dtype=np.uint8)]
+    scored = {}
+
+    for label, primer_hits in hits.items():
+        if not primer_hits:
+            scored[label] = []
+            continue
+
+        primer = args.fwd_primer if label.startswith("Forward") else args.rev_primer
+        sites = binding_sites(seq_masks, primer_hits, len(primer), on_minus_strand=label.endswith("RC"))
+        penalty, tm = score_sites(primer, sites, args.three_prime_window, args.three_prime_weight)
+
+        keep = np.ones(len(primer_hits), dtype=bool)
+        if args.max_penalty is not None:
+            keep &= penalty <= args.max_penalty
+        if args.min_tm is not None:
+            keep &= tm >= args.min_tm
+
+        scored[label] = [
+            hit + (float(p), float(t))
+            for hit, p, t, k in zip(primer_hits, penalty, tm, keep)
+            if k
+        ]
+
+    return scored
+
+def score_description(f_hit, r_hit):
+    """Return the FASTA description and the summed penalty/lowest Tm of the primers of one amplicon"""
+    primer_hits = [hit for hit in (f_hit, r_hit) if hit is not None]
+    penalty = sum(hit[3] for hit in primer_hits)
+    tm = min(hit[4] for hit in primer_hits)
+    fields = [f"penalty={penalty:.2f}", f"min_tm={tm:.1f}"]
+    if f_hit is not None:
+        fields.append(f"fwd_penalty={f_hit[3]:.2f} fwd_tm={f_hit[4]:.1f}")
+    if r_hit is not None:
+        fields.append(f"rev_penalty={r_hit[3]:.2f} rev_tm={r_hit[4]:.1f}")
+
+    return " ".join(fields), penalty, tm
+
+def find_amplicons(contig_id, seq_len, fwd_hits, fwd_rc_hits, rev_hits, rev_rc_hits, min_len, max_len):
+    """
+    Pair the primer hits of a single contig into plausible amplicons.
+    Returns a list of (start, end, length, orientation, fwd_hit, rev_hit) tuples,
+    fwd_hit/rev_hit are None for the primer missing in single-end edge cases.
+    """
+    amplicons = []
+
+    # fwd + rev_rc (original orientation)
+    for f_hit in fwd_hits:
+        for r_hit in rev_rc_hits:
+            if r_hit[0] > f_hit[1]:
+                length = r_hit[1] - f_hit[0]
+                if min_len <= length <= max_len:
+                    amplicons.append((f_hit[0], r_hit[1], length, "fwd+rev_rc", f_hit, r_hit))
+
+    # fwd_rc + rev (flipped orientation)
+    for f_hit in fwd_rc_hits:
+        for r_hit in rev_hits:
+            if f_hit[0] > r_hit[1]:
+                length = f_hit[1] - r_hit[0]
+                if min_len <= length <= max_len:
+                    amplicons.append((r_hit[0], f_hit[1], length, "fwd_rc+rev", f_hit, r_hit))
+
+    # Only look for single-end edge cases if no "normal" amplicon was found on this contig
+    if amplicons:
+        return amplicons
 
     # Forward primer near contig end
-    for f in [m for cid, m in fwd_matches if cid == contig_id]:
-        rev_hits_here = [r for cid, r in rev_rc_matches + rev_matches if cid == contig_id]
-        if not rev_hits_here and seq_len - f.end() <= edge_distance:
-            amp_seq = str(record.seq[f.start():])
-            length = len(amp_seq)
-            if min_len <= length <= max_len:
-                amplicons.append((contig_id, f, None, length, "fwd_to_end"))
-                print(f"Edge amplicon: {contig_id} fwd_to_end start={f.start()+1} end={seq_len} len={length}")
+    if not rev_rc_hits and not rev_hits:
+        for f_hit in fwd_hits:
+            if seq_len - f_hit[1] <= EDGE_DISTANCE:
+                length = seq_len - f_hit[0]
+                if min_len <= length <= max_len:
+                    amplicons.append((f_hit[0], seq_len, length, "fwd_to_end", f_hit, None))
+                    print(f"Edge amplicon: {contig_id} fwd_to_end start={f_hit[0]+1} end={seq_len} len={length}")
 
     # Reverse primer near contig start
-    for r in [m for cid, m in rev_rc_matches + rev_matches if cid == contig_id]:
-        fwd_hits_here = [f for cid, f in fwd_matches + fwd_rc_matches if cid == contig_id]
-        if not fwd_hits_here and r.start() <= edge_distance:
-            amp_seq = str(record.seq[:r.end()])
-            length = len(amp_seq)
-            if min_len <= length <= max_len:
-                amplicons.append((contig_id, None, r, length, "rev_to_start"))
-                print(f"Edge amplicon: {contig_id} rev_to_start start=1 end={r.end()} len={length}")
-
-if not amplicons:
-    raise ValueError("No plausible amplicon pairs found (check length thresholds or primer orientation)")
-
-print(f"Total plausible amplicons: {len(amplicons)}")
-
-
-# ------------------ Extract and save the amplicon sequence ------------------ #
-with open(fasta_out, "w") as out_f:
-    for n, (contig_id, f_match, r_match, length, orientation) in enumerate(amplicons, start=1):
-        record = record_dict[contig_id]
-
-        if orientation == "fwd+rev_rc":
-            amp_seq = str(record.seq[f_match.start():r_match.end()])
-            start, end = f_match.start(), r_match.end()
-        elif orientation == "fwd_rc+rev":
-            amp_seq = str(record.seq[r_match.start():f_match.end()].reverse_complement())
-            start, end = r_match.start(), f_match.end()
-        elif orientation == "fwd_to_end":
-            amp_seq = str(record.seq[f_match.start():])
-            start, end = f_match.start(), len(record.seq)
-        elif orientation == "rev_to_start":
-            amp_seq = str(record.seq[:r_match.end()])
-            start, end = 0, r_match.end()
-        else:
-            continue  # skip unknown orientation
-        
-        out_f.write(f">{record.id}_from{start}_to{end}_len{length}_orientation_{orientation}\n")
-        for j in range(0, len(amp_seq), 80):
-            out_f.write(amp_seq[j:j+80] + "\n")
-
-        print(f"Amplicon {n}: Contig={contig_id} start={start+1} end={end} inclusive length={end-start} orientation={orientation}")
+    if not fwd_hits and not fwd_rc_hits:
+        for r_hit in rev_rc_hits + rev_hits:
+            if r_hit[0] <= EDGE_DISTANCE:
+                length = r_hit[1]
+                if min_len <= length <= max_len:
+                    amplicons.append((0, r_hit[1], length, "rev_to_start", None, r_hit))
+                    print(f"Edge amplicon: {contig_id} rev_to_start start=1 end={r_hit[1]} len={length}")
+
+    return amplicons
+
+
+def run_pcr(args):
+    """Stream the template contigs and write all plausible amplicons"""
+    patterns = compile_primers(args.fwd_primer, args.rev_primer, args.max_errors)
+
+    # Contigs are read one at a time with SeqIO.parse, so peak memory is bounded by the
+    # largest contig and not by the size of the input file
+    n_amplicons = 0
+    score_rows = []
+
+    with open(args.fasta_out, "w") as out_f:
+        for record in SeqIO.parse(args.fasta, "fasta"):
+            seq_string = str(record.seq).upper()
+            contig_id = record.id
+
+            # Search all four orientations
+            hits = {label: find_hits(pattern, seq_string) for label, pattern in patterns.items()}
+
+            # Score binding sites after the regex scan, only the (few) hits are touched
+            if args.score:
+                hits = score_hits(seq_string, hits, args)
+
+            # Print information about mismatches
+            for label, primer_hits in hits.items():
+                for hit in primer_hits:
+                    start, end, fuzzy_counts = hit[:3]
+                    scores = f", penalty={hit[3]:.2f}, tm={hit[4]:.1f}" if args.score else ""
+                    print(f"{label} primer match: contig={contig_id}  start={start}, end={end}, {fuzzy_summary(fuzzy_counts)}{scores}")
+
+            amplicons = find_amplicons(
+                contig_id,
+                len(seq_string),
+                hits["Forward"],
+                hits["Forward RC"],
+                hits["Reverse"],
+                hits["Reverse RC"],
+                args.min_len,
+                args.max_len,
+            )
+
+            # Extract and save the amplicon sequences of this contig
+            for start, end, length, orientation, f_hit, r_hit in amplicons:
+                n_amplicons += 1
+                amplicon_id = f"{contig_id}_from{start}_to{end}_len{length}_orientation_{orientation}"
+
+                if orientation == "fwd_rc+rev":
+                    amp_seq = str(record.seq[start:end].reverse_complement())
+                else:
+                    amp_seq = str(record.seq[start:end])
+
+                if args.score:
+                    description, penalty, tm = score_description(f_hit, r_hit)
+                    score_rows.append((amplicon_id, contig_id, start, end, length, orientation, penalty, tm))
+                    out_f.write(f">{amplicon_id} {description}\n")
+                else:
+                    out_f.write(f">{amplicon_id}\n")
+                for j in range(0, len(amp_seq), 80):
+                    out_f.write(amp_seq[j:j+80] + "\n")
+
+                print(f"Amplicon {n_amplicons}: Contig={contig_id} start={start+1} end={end} inclusive length={end-start} orientation={orientation}")
+
+    if not n_amplicons:
+        raise ValueError("No plausible amplicon pairs found (check length thresholds or primer orientation)")
+
+    print(f"Total plausible amplicons: {n_amplicons}")
+
+    # Rank amplicons by score, lowest summed primer penalty first, higher Tm breaks ties
+    if args.score_table:
+        score_rows.sort(key=lambda row: (row[6], -row[7]))
+        with open(args.score_table, "w") as out_t:
+            out_t.write("rank\tamplicon\tcontig\tstart\tend\tlength\torientation\tpenalty\tmin_tm\n")
+            for rank, (amplicon_id, contig_id, start, end, length, orientation, penalty, tm) in enumerate(score_rows, start=1):
+                out_t.write(f"{rank}\t{amplicon_id}\t{contig_id}\t{start}\t{end}\t{length}\t{orientation}\t{penalty:.2f}\t{tm:.1f}\n")
+        print(f"Amplicon scores written to {args.score_table}")
+
+
+# ------------------------------- Read trimming ------------------------------ #
+# Compiled primer patterns of the current (worker) process, set by init_trimmer
+TRIM_PATTERNS = None
+TRIM_WINDOW = None
+
+def init_trimmer(fwd_primer, rev_primer, max_errors, search_window):
+    """Compile the primer patterns once per worker process"""
+    global TRIM_PATTERNS, TRIM_WINDOW
+    TRIM_PATTERNS = compile_primers(fwd_primer, rev_primer, max_errors)
+    TRIM_WINDOW = search_window
+
+def search_end(pattern, seq_string, at_start):
+    """Best primer hit within the first/last TRIM_WINDOW bases as (start, end, errors) in read coordinates"""
+    if at_start:
+        m = pattern.search(seq_string, 0, min(TRIM_WINDOW, len(seq_string)))
+    else:
+        m = pattern.search(seq_string, max(len(seq_string) - TRIM_WINDOW, 0))
+    if m is None:
+        return None
+    return (m.start(), m.end(), sum(m.fuzzy_counts))
+
+def hit_support(hits):
+    """Rank an orientation by the number of primers found, fewer errors break ties"""
+    found = [hit for hit in hits if hit is not None]
+    return (len(found), -sum(hit[2] for hit in found))
+
+def orient_and_trim(seq_string):
+    """
+    Locate the primers near both ends of one read and decide on its orientation.
+    Returns (strand, fwd_hit, rev_hit, trim_start, trim_end); hits and trim positions
+    are in coordinates of the oriented read (reverse complemented for strand "-").
+    """
+    seq_upper = seq_string.upper()
+    read_len = len(seq_upper)
+
+    # Read in forward orientation: fwd primer at the start, rev primer (rc) at the end
+    plus = (
+        search_end(TRIM_PATTERNS["Forward"], seq_upper, at_start=True),
+        search_end(TRIM_PATTERNS["Reverse RC"], seq_upper, at_start=False),
+    )
+    # Read in reverse orientation: rev primer at the start, fwd primer (rc) at the end
+    minus = (
+        search_end(TRIM_PATTERNS["Reverse"], seq_upper, at_start=True),
+        search_end(TRIM_PATTERNS["Forward RC"], seq_upper, at_start=False),
+    )
+
+    plus_support = hit_support(plus)
+    minus_support = hit_support(minus)
+
+    if plus_support[0] == 0 and minus_support[0] == 0:
+        return ("none", None, None, 0, read_len)
+
+    if plus_support >= minus_support:
+        fwd_hit, rev_hit = plus
+        strand = "+"
+    else:
+        # Flip coordinates to the reverse complemented read
+        rev_at_start, fwd_at_end = minus
+        fwd_hit = None if fwd_at_end is None else (read_len - fwd_at_end[1], read_len - fwd_at_end[0], fwd_at_end[2])
+        rev_hit = None if rev_at_start is None else (read_len - rev_at_start[1], read_len - rev_at_start[0], rev_at_start[2])
+        strand = "-"
+
+    trim_start = fwd_hit[1] if fwd_hit is not None else 0
+    trim_end = rev_hit[0] if rev_hit is not None else read_len
+
+    return (strand, fwd_hit, rev_hit, trim_start, max(trim_end, trim_start))
+
+def trim_batch(batch):
+    """
+    Orient and trim a batch of (read_id, sequence, quality) records, quality is None for FASTA input.
+    Returns (read_id, sequence, quality, strand, fwd_hit, rev_hit, read_len) per read, in input order.
+    """
+    results = []
+    for read_id, seq_string, quality in batch:
+        strand, fwd_hit, rev_hit, trim_start, trim_end = orient_and_trim(seq_string)
+
+        if strand == "-":
+            seq_string = str(Seq(seq_string).reverse_complement())
+            quality = quality[::-1] if quality is not None else None
+
+        trimmed_seq = seq_string[trim_start:trim_end]
+        trimmed_qual = quality[trim_start:trim_end] if quality is not None else None
+
+        results.append((read_id, trimmed_seq, trimmed_qual, strand, fwd_hit, rev_hit, len(seq_string)))
+
+    return results
+
+def open_reads(path, mode="rt"):
+    """Open plain or gzipped sequence files"""
+    if str(path).endswith(".gz"):
+        return gzip.open(path, mode)
+    return open(path, mode)
+
+def is_fastq(path):
+    """Guess the read format from the file name"""
+    name = str(path).lower().removesuffix(".gz")
+    return name.endswith((".fastq", ".fq"))
+
+def read_batches(handle, fastq, batch_size):
+    """Stream reads as lists of (read_id, sequence, quality) tuples"""
+    if fastq:
+        records = FastqGeneralIterator(handle)
+    else:
+        records = ((title, seq, None) for title, seq in SimpleFastaParser(handle))
+
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            return
+        yield batch
+
+def format_hit(hit):
+    """Render an optional primer hit as start, end and errors columns"""
+    if hit is None:
+        return "NA\tNA\tNA"
+    return f"{hit[0]}\t{hit[1]}\t{hit[2]}"
+
+def run_trimming(args):
+    """Stream reads through a process pool and write oriented, trimmed reads in input order"""
+    fastq = is_fastq(args.reads)
+    counts = {"reads": 0, "kept": 0, "both": 0, "fwd_only": 0, "rev_only": 0, "none": 0, "+": 0, "-": 0}
+
+    initargs = (args.fwd_primer, args.rev_primer, args.max_errors, args.search_window)
+    pool = Pool(args.threads, initializer=init_trimmer, initargs=initargs) if args.threads > 1 else None
+    if pool is None:
+        init_trimmer(*initargs)
+
+    stats_f = open(args.hit_stats, "w") if args.hit_stats else None
+    if stats_f:
+        stats_f.write("read_id\tread_len\tstrand\tfwd_start\tfwd_end\tfwd_errors\trev_start\trev_end\trev_errors\ttrimmed_len\tkept\n")
+
+    with open_reads(args.reads) as in_f, open_reads(args.reads_out, "wt") as out_f:
+        batches = read_batches(in_f, fastq, args.batch_size)
+        # imap keeps the results in input order while batches are processed in parallel
+        results = pool.imap(trim_batch, batches) if pool else map(trim_batch, batches)
+
+        for batch_results in results:
+            for read_id, seq_string, quality, strand, fwd_hit, rev_hit, read_len in batch_results:
+                counts["reads"] += 1
+                if fwd_hit is not None and rev_hit is not None:
+                    counts["both"] += 1
+                elif fwd_hit is not None:
+                    counts["fwd_only"] += 1
+                elif rev_hit is not None:
+                    counts["rev_only"] += 1
+                else:
+                    counts["none"] += 1
+                if strand != "none":
+                    counts[strand] += 1
+
+                keep = strand != "none" and len(seq_string) > 0
+                if args.require_both:
+                    keep = keep and fwd_hit is not None and rev_hit is not None
+
+                if keep:
+                    counts["kept"] += 1
+                    if fastq:
+                        out_f.write(f"@{read_id}\n{seq_string}\n+\n{quality}\n")
+                    else:
+                        out_f.write(f">{read_id}\n{seq_string}\n")
+
+                if stats_f:
+                    stats_f.write(f"{read_id.split()[0]}\t{read_len}\t{strand}\t{format_hit(fwd_hit)}\t{format_hit(rev_hit)}\t{len(seq_string)}\t{int(keep)}\n")
+
+    if stats_f:
+        stats_f.close()
+    if pool:
+        pool.close()
+        pool.join()
+
+    print(f"Reads processed: {counts['reads']}")
+    print(f"  both primers: {counts['both']}, fwd only: {counts['fwd_only']}, rev only: {counts['rev_only']}, no primer: {counts['none']}")
+    print(f"  kept orientation (+): {counts['+']}, reverse complemented (-): {counts['-']}")
+    print(f"Trimmed reads written to {args.reads_out}: {counts['kept']}")
+
+
+def main():
+    args = parse_args()
+
+    if args.reads:
+        run_trimming(args)
+    else:
+        run_pcr(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,300 @@
+"""
+Title: Normalize and rarefy OTU tables
+Description: Normalizes the OTU tables written by paf_to_matrix.py and idxstats_to_matrix.py (dense TSV or sparse mtx/npz) to relative abundance, CPM, RPKM or TPM, or rarefies them to an even depth. All methods work column-wise on a sparse matrix, rarefaction draws every sample with a seeded multivariate hypergeometric sampler, in parallel across samples.
+Date: 2026-10-19
+Tags: table_generation, normalization, rarefaction, read_mapping
+Usage: python normalize_otu_table.py -i results/mapping_counts/otu_table.tsv -m relative cpm rarefy --depth 10000 --threads 8
+"""
+
+import pandas as pd
+import numpy as np
+from pathlib import Path
+import argparse
+import sys
+from multiprocessing import Pool
+from scipy import io, sparse
+
+
+METHODS = ["relative", "cpm", "rpkm", "tpm", "rarefy"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Normalize (relative abundance, CPM, RPKM, TPM) or rarefy an OTU table."
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        required=True,
+        help="OTU table: dense TSV (e.g. otu_table.tsv) or sparse .mtx/.npz with <prefix>_rows.tsv "
+        "and <prefix>_samples.tsv next to it",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_prefix",
+        type=str,
+        default=None,
+        help="Prefix of the output tables, one <prefix>_<method> per method (default: input without suffix)",
+    )
+    parser.add_argument(
+        "-m",
+        "--method",
+        nargs="+",
+        choices=METHODS,
+        default=["relative"],
+        help="Normalization method(s) (default: relative)",
+    )
+    parser.add_argument(
+        "--lengths",
+        type=str,
+        default=None,
+        help="Reference lengths for rpkm/tpm: a samtools idxstats output (e.g. barcode01_stats.tsv) "
+        "or a TSV with a header and the row names and lengths in the first two columns",
+    )
+    parser.add_argument(
+        "--depth",
+        type=int,
+        default=None,
+        help="Rarefaction depth, samples with fewer reads are dropped (default: smallest sample)",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=1,
+        help="Random seed of the rarefaction, results do not depend on --threads (default: 1)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of worker processes for the rarefaction (default: 1)",
+    )
+    return parser.parse_args()
+
+
+# ------------------------------- Read and write ------------------------------- #
+def sparse_prefix(path):
+    """
+    Prefix of a sparse table, its row and sample names are in <prefix>_rows.tsv and <prefix>_samples.tsv.
+    """
+    return path.with_suffix("")
+
+
+def read_otu_table(path):
+    """
+    Reads an OTU table into a sparse CSC matrix (rows x samples), a table with the row names
+    (first column) and any annotation columns, and the sample names.
+    """
+    if path.suffix in (".mtx", ".npz"):
+        prefix = sparse_prefix(path)
+        matrix = io.mmread(path) if path.suffix == ".mtx" else sparse.load_npz(path)
+        rows = pd.read_csv(f"{prefix}_rows.tsv", sep="\t")
+        samples = pd.read_csv(f"{prefix}_samples.tsv", sep="\t").iloc[:, 0].astype(str)
+        return sparse.csc_matrix(matrix), rows, pd.Index(samples, name="sample")
+
+    table = pd.read_csv(path, sep="\t")
+    # First column holds the row names, non-numeric columns (e.g. genus) are annotations
+    numeric = [col for col in table.columns[1:] if pd.api.types.is_numeric_dtype(table[col])]
+    rows = table.drop(columns=numeric)
+    matrix = sparse.csc_matrix(table[numeric].fillna(0).to_numpy())
+    return matrix, rows, pd.Index(numeric, name="sample")
+
+
+def write_otu_table(matrix, rows, samples, prefix, sparse_suffix=None):
+    """
+    Writes a normalized table in the layout of the input: dense TSV with the annotation columns,
+    or sparse .mtx/.npz with the row and sample names next to it.
+    """
+    if sparse_suffix == ".mtx":
+        field = "integer" if matrix.dtype.kind in "iu" else "real"
+        io.mmwrite(f"{prefix}.mtx", matrix.tocoo(), field=field)
+    elif sparse_suffix == ".npz":
+        sparse.save_npz(f"{prefix}.npz", matrix.tocsr())
+
+    if sparse_suffix:
+        rows.to_csv(f"{prefix}_rows.tsv", sep="\t", index=False)
+        samples.to_frame(index=False).to_csv(f"{prefix}_samples.tsv", sep="\t", index=False)
+        return f"{prefix}{sparse_suffix}"
+
+    table = pd.concat(
+        [rows.reset_index(drop=True), pd.DataFrame(matrix.toarray(), columns=samples)], axis=1
+    )
+    table.to_csv(f"{prefix}.tsv", sep="\t", index=False)
+    return f"{prefix}.tsv"
+
+
+def read_lengths(lengths_file, row_names):
+    """
+    Length per row, NaN for rows without a (positive) length such as "unassigned".
+    Accepts a samtools idxstats output (no header) or a TSV with a header (name, length).
+    """
+    lengths = pd.read_csv(lengths_file, sep="\t", header=None)
+    if not pd.api.types.is_numeric_dtype(lengths[1]):
+        lengths = lengths.iloc[1:]
+    lengths = pd.Series(
+        pd.to_numeric(lengths[1]).to_numpy(dtype=float), index=lengths[0].astype(str)
+    )
+    lengths = lengths[~lengths.index.duplicated()]
+    lengths = lengths.reindex(row_names.astype(str)).to_numpy(copy=True)
+    lengths[~(lengths > 0)] = np.nan
+    return lengths
+
+
+# ------------------------------- Normalization -------------------------------- #
+def scale_columns(matrix, factors):
+    """
+    Multiplies every column of a sparse matrix by its factor.
+    """
+    return (matrix @ sparse.diags(factors)).tocsc()
+
+
+def column_totals(matrix):
+    """
+    Sum of every sample (column) as a float array.
+    """
+    return np.asarray(matrix.sum(axis=0)).ravel().astype(float)
+
+
+def safe_inverse(values):
+    """
+    1 / values, 0 where values is 0 (empty samples stay empty).
+    """
+    return np.divide(1, values, out=np.zeros_like(values, dtype=float), where=values != 0)
+
+
+def relative_abundance(matrix):
+    """
+    Counts divided by the sample total.
+    """
+    return scale_columns(matrix, safe_inverse(column_totals(matrix)))
+
+
+def cpm(matrix):
+    """
+    Counts per million reads of the sample.
+    """
+    return scale_columns(matrix, 1e6 * safe_inverse(column_totals(matrix)))
+
+
+def rpkm(matrix, lengths):
+    """
+    Reads per kilobase of reference per million mapped reads. Rows without a length are dropped
+    before the totals are taken, so unassigned reads do not count as mapped.
+    """
+    keep = ~np.isnan(lengths)
+    matrix = matrix[keep]
+    per_kb = sparse.diags(1e3 / lengths[keep]) @ matrix
+    return scale_columns(per_kb, 1e6 * safe_inverse(column_totals(matrix))), keep
+
+
+def tpm(matrix, lengths):
+    """
+    Transcripts (here: reads) per million: length-normalized rates scaled to a sum of 1e6 per sample.
+    """
+    keep = ~np.isnan(lengths)
+    rates = (sparse.diags(1 / lengths[keep]) @ matrix[keep]).tocsc()
+    return scale_columns(rates, 1e6 * safe_inverse(column_totals(rates))), keep
+
+
+# -------------------------------- Rarefaction --------------------------------- #
+def rarefy_block(block):
+    """
+    Rarefies the samples of one CSC block: every sample is drawn without replacement
+    from its non-zero counts with its own seeded generator.
+    """
+    indptr, data, seeds, depth = block
+    rarefied = np.empty_like(data)
+    for col, seed in enumerate(seeds):
+        start, end = indptr[col], indptr[col + 1]
+        rng = np.random.default_rng(seed)
+        rarefied[start:end] = rng.multivariate_hypergeometric(
+            data[start:end], depth, method="marginals"
+        )
+    return rarefied
+
+
+def rarefy(matrix, depth, seed=1, threads=1):
+    """
+    Subsamples every sample to depth reads without replacement (multivariate hypergeometric
+    over its non-zero counts). Each sample gets a child of one SeedSequence, so the result is
+    the same for any number of threads. Returns the rarefied matrix and the kept sample mask.
+    """
+    totals = column_totals(matrix)
+    keep = totals >= depth
+    matrix = matrix[:, keep].tocsc()
+    matrix.sort_indices()
+    data = matrix.data.astype(np.int64)
+    seeds = np.random.SeedSequence(seed).spawn(matrix.shape[1])
+
+    # Blocks of samples, sliced from the CSC arrays
+    n_blocks = max(1, min(matrix.shape[1], 4 * threads))
+    bounds = np.linspace(0, matrix.shape[1], n_blocks + 1).astype(int)
+    blocks = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        lo, hi = matrix.indptr[start], matrix.indptr[end]
+        blocks.append(
+            (matrix.indptr[start : end + 1] - lo, data[lo:hi], seeds[start:end], depth)
+        )
+
+    if threads > 1 and len(blocks) > 1:
+        with Pool(threads) as pool:
+            rarefied = pool.map(rarefy_block, blocks)
+    else:
+        rarefied = [rarefy_block(block) for block in blocks]
+
+    rarefied = sparse.csc_matrix(
+        (np.concatenate(rarefied) if rarefied else data, matrix.indices, matrix.indptr),
+        shape=matrix.shape,
+    )
+    rarefied.eliminate_zeros()
+    return rarefied, keep
+
+
+def main():
+    args = parse_args()
+    input_path = Path(args.input)
+    output_prefix = args.output_prefix or str(input_path.with_suffix(""))
+    sparse_suffix = input_path.suffix if input_path.suffix in (".mtx", ".npz") else None
+    Path(output_prefix).parent.mkdir(parents=True, exist_ok=True)
+
+    matrix, rows, samples = read_otu_table(input_path)
+    print(f"{matrix.shape[0]} rows x {matrix.shape[1]} samples, {matrix.nnz} non-zero counts")
+
+    if {"rpkm", "tpm"} & set(args.method):
+        if not args.lengths:
+            sys.exit("rpkm/tpm need --lengths. Exiting.")
+        lengths = read_lengths(args.lengths, rows.iloc[:, 0])
+        if np.isnan(lengths).any():
+            print(f"{np.isnan(lengths).sum()} rows without a length are left out of rpkm/tpm")
+
+    written = []
+    for method in args.method:
+        out_rows, out_samples = rows, samples
+        if method == "relative":
+            normalized = relative_abundance(matrix)
+        elif method == "cpm":
+            normalized = cpm(matrix)
+        elif method in ("rpkm", "tpm"):
+            normalized, keep = (rpkm if method == "rpkm" else tpm)(matrix, lengths)
+            out_rows = rows[keep]
+        else:
+            if not np.allclose(matrix.data, np.round(matrix.data)):
+                sys.exit("Rarefaction needs integer counts (not EM or normalized tables). Exiting.")
+            totals = column_totals(matrix)
+            depth = args.depth if args.depth is not None else int(totals.min())
+            normalized, keep = rarefy(matrix, depth, args.seed, args.threads)
+            out_samples = samples[keep]
+            if not keep.all():
+                print(f"Dropped {(~keep).sum()} samples with fewer than {depth} reads: {list(samples[~keep])}")
+            print(f"Rarefied {keep.sum()} samples to {depth} reads")
+
+        written.append(
+            write_otu_table(normalized, out_rows, out_samples, f"{output_prefix}_{method}", sparse_suffix)
+        )
+
+    print(f"Finished! {', '.join(Path(f).name for f in written)} written")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,59 @@
 import pandas as pd
+import numpy as np
 from pathlib import Path
 import argparse
+import csv
+import hashlib
+import io
+import os
 import sys
+from functools import partial
+from itertools import islice
+from multiprocessing import Pool
 import matplotlib.pyplot as plt
 
 
+# The 12 fixed PAF columns and the dtypes they are parsed with
+PAF_COLUMNS = [
+    "qname",
+    "qlen",
+    "qstart",
+    "qend",
+    "strand",
+    "tname",
+    "tlen",
+    "tstart",
+    "tend",
+    "nmatch",
+    "alen",
+    "mapq",
+]
+PAF_DTYPES = {
+    "qname": str,
+    "qlen": np.int32,
+    "qstart": np.int32,
+    "qend": np.int32,
+    "strand": str,
+    "tname": str,
+    "tlen": np.int64,
+    "tstart": np.int64,
+    "tend": np.int64,
+    "nmatch": np.int32,
+    "alen": np.int32,
+    "mapq": np.uint8,
+}
+
+# Bump when the cached columns change, older caches are then rebuilt
+CACHE_VERSION = "2"
+
+# Fixed bin edges of the diagnostic histograms, values outside the range go to the outer bins
+HIST_BINS = {
+    "qcov": np.linspace(0, 1, 51),
+    "identity": np.linspace(0, 1, 101),
+    "mapq": np.arange(257),
+}
+
+
 def parse_args():
     parser = argparse.ArgumentParser(
         description="Generate OTU tables and summary read counts from per-sample mapping stats files."
@@ -55,163 +104,1024 @@ def parse_args():
         default=30,
         help="Minimum MAPQ threshold (default: 30, keeps multimappers (mapq 0)",
     )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=1_000_000,
+        help="Number of PAF lines parsed and filtered at once (default: 1000000)",
+    )
+    parser.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of PAF files processed in parallel worker processes (default: 1)",
+    )
+    parser.add_argument(
+        "--cache",
+        action="store_true",
+        help="Cache the parsed PAF columns as <sample>.paf.feather next to each PAF and reuse them "
+        "on reruns (memory-mapped, rebuilt automatically when the PAF changed). Needs pyarrow",
+    )
+    parser.add_argument(
+        "--sparse_format",
+        nargs="+",
+        choices=["mtx", "parquet", "npz", "h5"],
+        default=None,
+        help="Write the OTU tables as sparse matrices instead of dense TSVs: Matrix Market (mtx), "
+        "long-format Parquet (parquet), scipy NPZ (npz) and/or HDF5 (h5). Needs scipy (h5 also needs h5py)",
+    )
+    parser.add_argument(
+        "--no_plots",
+        action="store_true",
+        help="Do not draw the qcov/identity/mapq histograms (the binned counts are still written)",
+    )
+    parser.add_argument(
+        "--per_sample_plots",
+        action="store_true",
+        help="Also draw the qcov/identity/mapq histograms per sample (into <output_folder>/histograms)",
+    )
+    parser.add_argument(
+        "--sweep_cov",
+        nargs="+",
+        type=float,
+        default=None,
+        help="Sweep mode: query coverage thresholds to evaluate (default: --cov only)",
+    )
+    parser.add_argument(
+        "--sweep_id",
+        nargs="+",
+        type=float,
+        default=None,
+        help="Sweep mode: sequence identity thresholds to evaluate (default: --id only)",
+    )
+    parser.add_argument(
+        "--sweep_mapq",
+        nargs="+",
+        type=int,
+        default=None,
+        help="Sweep mode: MAPQ thresholds to evaluate (default: --mapq only)",
+    )
+    parser.add_argument(
+        "--em",
+        choices=["AS", "identity", "uniform"],
+        default=None,
+        help="Also estimate reads per target by expectation-maximization over all retained alignments "
+        "of each read, weighting alignments by AS, identity or uniformly (otu_table_em*.tsv). Needs scipy",
+    )
+    parser.add_argument(
+        "--em_scale",
+        type=float,
+        default=5.0,
+        help="Score difference to the best alignment of a read (AS points or identity percent) "
+        "that lowers the EM weight of an alignment e-fold (default: 5)",
+    )
+    parser.add_argument(
+        "--em_tol",
+        type=float,
+        default=0.01,
+        help="EM stops when no target changes by more than this many reads (default: 0.01)",
+    )
+    parser.add_argument(
+        "--em_max_iter",
+        type=int,
+        default=1000,
+        help="Maximum number of EM iterations (default: 1000)",
+    )
+    parser.add_argument(
+        "--breadth",
+        action="store_true",
+        help="Write the breadth of coverage (covered fraction) of every target per sample, "
+        "from the merged target intervals of the retained alignments (target_breadth.tsv)",
+    )
+    parser.add_argument(
+        "--min_breadth",
+        type=float,
+        default=None,
+        help="Drop targets covered below this fraction in a sample from its OTU tables "
+        "(implies --breadth, default: no filter)",
+    )
+    parser.add_argument(
+        "--taxonomy",
+        type=str,
+        default=None,
+        help="LCA mode: taxonomy as a TSV with taxid and parent columns (optional rank and name) "
+        "or NCBI nodes.dmp (names from names.dmp next to it). Each read is assigned to the lowest "
+        "common ancestor of its equally-best hits (same qcov and AS). Needs --target_taxids",
+    )
+    parser.add_argument(
+        "--target_taxids",
+        type=str,
+        default=None,
+        help="LCA mode: two column tab-delimited file with the target (accession) and its taxid",
+    )
+    parser.add_argument(
+        "--lca_ranks",
+        nargs="+",
+        default=["species", "genus", "family"],
+        help="Ranks the LCA counts are summarized on, one otu_table_lca_<rank>.tsv each "
+        "(default: species genus family)",
+    )
 
     return parser.parse_args()
 
 
-def read_paf_with_AS(paf_file):
+def sniff_paf(paf_file):
     """
-    Reads a PAF file, keeping the first 12 standard columns and the AS:i: optional field.
-    Returns a DataFrame with AS as a separate column.
+    Returns the number of comment/empty lines at the start of a PAF file, up to the first alignment.
     """
-    rows = []
+    n_skip = 0
     with open(paf_file) as f:
         for line in f:
-            if line.startswith("#") or not line.strip():
-                continue
-            parts = line.strip().split("\t")
-            # First 12 standard columns
-            std_cols = parts[:12]
-            # Look for AS:i:<value> in optional fields
-            AS = None
-            for opt in parts[12:]:
-                if opt.startswith("AS:i:"):
-                    AS = int(opt.split(":")[-1])
-                    break
-            # Append row (first 12 + AS)
-            rows.append(std_cols + [AS])
-
-    # Create DataFrame
-    colnames = [
-        "qname",
-        "qlen",
-        "qstart",
-        "qend",
-        "strand",
-        "tname",
-        "tlen",
-        "tstart",
-        "tend",
-        "nmatch",
-        "alen",
-        "mapq",
-        "AS",
-    ]
-    df = pd.DataFrame(rows, columns=colnames)
-    return df
+            if line.strip() and not line.startswith("#"):
+                break
+            n_skip += 1
 
+    return n_skip
 
-def main():
-    # ----------------------------- Define parameters ---------------------------- #
-    args = parse_args()
-    input_folder = Path(args.input_folder)
-    taxon_path = Path(args.taxa_mapping)
-    stats_path = Path(args.stats_file) if args.stats_file else None
 
-    coverage_threshold = args.cov
-    identity_threshold = args.id
-    mapq_threshold = args.mapq
+def read_paf_chunks(paf_file, chunksize=1_000_000):
+    """
+    Reads a PAF file in chunks with the pandas C parser, keeping the first 12 standard columns
+    with explicit dtypes and the AS:i: optional field as a separate column.
+    Lines are read whole, so only lines starting with '#' are comments ('#' inside PanSN names is kept),
+    and the AS:i: tag is found at any position after the standard columns.
+    Adds query coverage (qcov) and sequence identity to every chunk.
+    """
+    reader = pd.read_csv(
+        paf_file,
+        sep="\x01",
+        header=None,
+        names=["line"],
+        dtype=str,
+        skiprows=sniff_paf(paf_file),
+        quoting=csv.QUOTE_NONE,
+        skip_blank_lines=True,
+        engine="c",
+        chunksize=chunksize,
+    )
 
-    output_folder = Path(args.output_folder)
-    output_folder.mkdir(parents=True, exist_ok=True)
+    for lines in reader:
+        # Comment lines after the first alignment
+        lines = lines["line"]
+        lines = lines[~lines.str.startswith("#")]
+        if lines.empty:
+            continue
 
-    # For testing (change to true for testing)
-    if False:
-        input_folder = Path("data_analysis/results/minimap2/")
-        taxon_path = Path("data/accession_to_genus.tsv")
-        stats_path = Path("data_analysis/results/seqkit/fastq_filtered.tsv")
-        output_folder = Path("data_analysis/results")
-        coverage_threshold = 0.9  # minimum fraction of query covered
-        identity_threshold = (
-            0.9  # optional, if computing identity from AS/optional tags
+        # Standard columns, the C parser drops the optional tags after them
+        chunk = pd.read_csv(
+            io.StringIO("\n".join(lines)),
+            sep="\t",
+            header=None,
+            names=PAF_COLUMNS,
+            usecols=PAF_COLUMNS,
+            dtype=PAF_DTYPES,
+            quoting=csv.QUOTE_NONE,
+            engine="c",
         )
-        mapq_threshold = 30
+        # AS:i:<value> from the optional tags, NaN if the alignment has none
+        AS = lines.str.extract(r"^(?:[^\t]*\t){12}(?:[^\t]*\t)*?AS:i:(-?\d+)", expand=False)
+        chunk["AS"] = pd.to_numeric(AS).astype(np.float32).to_numpy()
 
-    # ------------------------------- Read in taxa info --------------------------- #
-    taxon_df = pd.read_csv(taxon_path, sep="\t")
-    if "tname" not in taxon_df.columns:
-        taxon_df.columns = ["tname", "genus"]
+        # Calculate query coverage and identity
+        chunk["qcov"] = (chunk.qend - chunk.qstart + 1) / chunk.qlen
+        alen = chunk["alen"].to_numpy()
+        chunk["identity"] = np.divide(
+            chunk["nmatch"].to_numpy(), alen, out=np.full(len(chunk), np.nan), where=alen > 0
+        )
 
-    # ------------------------------- Read in PAFs ------------------------------- #
-    all_files = list(input_folder.glob("*.paf"))
-    dfs = []
+        yield chunk
 
-    # On all files
-    for paf_file in all_files:
-        barcode = paf_file.stem
-        df = read_paf_with_AS(paf_file)
-        df["sample"] = barcode
-        dfs.append(df)
 
-    if not dfs:
-        sys.exit("No PAF files found in input folder. Exiting.")
+def paf_fingerprint(paf_file, block_size=1 << 20):
+    """
+    Identifies the content of a PAF file by its size, mtime and a hash of its first and last MiB.
+    """
+    stat = os.stat(paf_file)
+    digest = hashlib.blake2b(digest_size=16)
+    with open(paf_file, "rb") as f:
+        digest.update(f.read(block_size))
+        if stat.st_size > block_size:
+            f.seek(max(stat.st_size - block_size, block_size))
+            digest.update(f.read(block_size))
 
-    df = pd.concat(dfs, ignore_index=True)
-
-    # ------------------------------ Filter PAFs -------------------------------- #
-    # Convert numeric columns to integers
-    df = df.copy()
-    numeric_cols = [
-        "qlen",
-        "qstart",
-        "qend",
-        "tlen",
-        "tstart",
-        "tend",
-        "nmatch",
-        "alen",
-        "mapq",
-        "AS",
-    ]
-    df[numeric_cols] = df[numeric_cols].apply(pd.to_numeric, errors="coerce")
-
-    # Calculate query coverage and identity
-    df["qcov"] = (df.qend - df.qstart + 1) / df.qlen
-    df["identity"] = df["nmatch"] / df["alen"].replace(0, pd.NA)
-
-    # Visualize the data distribution of key parameters
-    for col, bins in [("qcov", 50), ("identity", 100), ("mapq", 100)]:
-        plt.figure()
-        df[col].hist(bins=bins)
-        plt.title(col)
-        plt.xlabel(col)
-        plt.ylabel("Count")
-        plt.savefig(output_folder / f"{col}_hist.png")
-        plt.close()
-
-    # Filter on query coverage, sequency identity and mapq to discard uncertain hits
-    # But keep multimappers (map=0)
-    counts_before = df.groupby("sample").size()
-    before_filter = len(df)
-    df = df[
-        (df.qcov >= coverage_threshold)
-        & (df.identity >= identity_threshold)
-        & ((df.mapq == 0) | (df.mapq >= mapq_threshold))
+    return {
+        "cache_version": CACHE_VERSION,
+        "paf_size": str(stat.st_size),
+        "paf_mtime_ns": str(stat.st_mtime_ns),
+        "paf_fingerprint": digest.hexdigest(),
+    }
+
+
+def cache_path(paf_file):
+    """
+    Location of the parsed-alignment cache of a PAF file.
+    """
+    return Path(f"{paf_file}.feather")
+
+
+def read_cache_chunks(cache_file):
+    """
+    Yields the record batches of a cache file as DataFrames, the file is memory-mapped.
+    """
+    import pyarrow as pa
+
+    with pa.memory_map(str(cache_file)) as source:
+        reader = pa.ipc.open_file(source)
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i).to_pandas()
+
+
+def cached_paf_chunks(paf_file, chunksize=1_000_000):
+    """
+    Same chunks as read_paf_chunks, but served from an uncompressed Feather (Arrow IPC) cache
+    next to the PAF file if one exists that matches the PAF size, mtime and content fingerprint.
+    Otherwise the PAF is parsed and the cache is (re)built on the way.
+    """
+    import pyarrow as pa
+
+    cache_file = cache_path(paf_file)
+    fingerprint = paf_fingerprint(paf_file)
+
+    if cache_file.exists():
+        try:
+            with pa.memory_map(str(cache_file)) as source:
+                metadata = pa.ipc.open_file(source).schema.metadata or {}
+            metadata = {key.decode(): value.decode() for key, value in metadata.items()}
+        except (pa.ArrowInvalid, OSError):
+            metadata = {}
+
+        if metadata == fingerprint:
+            print(f"Reading parsed alignments from cache {cache_file}")
+            yield from read_cache_chunks(cache_file)
+            return
+        print(f"Cache {cache_file} is stale, rebuilding it")
+
+    # Write to a temporary file first, so an interrupted run never leaves a truncated cache behind
+    tmp_file = cache_file.with_name(cache_file.name + ".tmp")
+    writer = None
+    try:
+        for chunk in read_paf_chunks(paf_file, chunksize):
+            batch = pa.RecordBatch.from_pandas(chunk, preserve_index=False)
+            if writer is None:
+                schema = batch.schema.with_metadata(fingerprint)
+                writer = pa.ipc.new_file(str(tmp_file), schema)
+            writer.write_batch(batch.replace_schema_metadata(fingerprint))
+            yield chunk
+        if writer is not None:
+            writer.close()
+            writer = None
+            os.replace(tmp_file, cache_file)
+    finally:
+        if writer is not None:
+            writer.close()
+        if tmp_file.exists():
+            tmp_file.unlink()
+
+
+def histogram_counts(chunk):
+    """
+    Counts of qcov, identity and mapq of one chunk in the fixed HIST_BINS.
+    """
+    counts = {}
+    for col in ["qcov", "identity"]:
+        values = chunk[col].to_numpy(np.float64)
+        values = values[~np.isnan(values)]
+        edges = HIST_BINS[col]
+        counts[col], _ = np.histogram(np.clip(values, edges[0], edges[-1]), bins=edges)
+    counts["mapq"] = np.bincount(chunk["mapq"].to_numpy(), minlength=len(HIST_BINS["mapq"]) - 1)
+    return counts
+
+
+def plot_histogram(counts, col, title, out_file):
+    """
+    Draws a histogram from binned counts only.
+    """
+    edges = HIST_BINS[col]
+    if col == "mapq":
+        # Only show the mapq range that is used
+        used = np.flatnonzero(counts)
+        last = used[-1] + 1 if len(used) else 1
+        counts, edges = counts[:last], edges[: last + 1]
+
+    plt.figure()
+    plt.bar(edges[:-1], counts, width=np.diff(edges), align="edge")
+    plt.grid(True)
+    plt.title(title)
+    plt.xlabel(col)
+    plt.ylabel("Count")
+    plt.savefig(out_file)
+    plt.close()
+
+
+def histograms_to_long(histograms):
+    """
+    Long table (sample, metric, bin_start, bin_end, count) of binned counts per sample.
+    """
+    tables = []
+    for sample, sample_counts in histograms.items():
+        for col, counts in sample_counts.items():
+            edges = HIST_BINS[col]
+            tables.append(
+                pd.DataFrame(
+                    {
+                        "sample": sample,
+                        "metric": col,
+                        "bin_start": edges[:-1],
+                        "bin_end": edges[1:],
+                        "count": counts,
+                    }
+                )
+            )
+    return pd.concat(tables, ignore_index=True)
+
+
+def threshold_grid(coverage_thresholds, identity_thresholds, mapq_thresholds):
+    """
+    All (cov, id, mapq) combinations of the given thresholds, duplicates removed.
+    """
+    return list(
+        dict.fromkeys(
+            (cov, identity, mapq)
+            for cov in coverage_thresholds
+            for identity in identity_thresholds
+            for mapq in mapq_thresholds
+        )
+    )
+
+
+def filter_masks(df, settings):
+    """
+    Filter on query coverage, sequence identity and mapq to discard uncertain hits
+    But keep multimappers (map=0)
+    Returns one boolean mask per (cov, id, mapq) setting. The comparison per distinct
+    threshold is computed once and shared between all settings using it.
+    """
+    qcov = df["qcov"].to_numpy()
+    identity = df["identity"].to_numpy()
+    mapq = df["mapq"].to_numpy()
+
+    cov_masks = {cov: qcov >= cov for cov, _, _ in settings}
+    id_masks = {id_: identity >= id_ for _, id_, _ in settings}
+    mapq_masks = {mq: (mapq == 0) | (mapq >= mq) for _, _, mq in settings}
+
+    return [cov_masks[cov] & id_masks[id_] & mapq_masks[mq] for cov, id_, mq in settings]
+
+
+# Best hit per query: highest qcov, then highest AS, highest mapq, longest aln as tie breaker
+BEST_HIT_KEYS = ["qcov", "AS", "mapq", "alen"]
+
+
+def encode_names(names, name_codes):
+    """
+    Integer codes for a column of names. name_codes maps name -> code and is extended
+    with names not seen before, so codes stay stable across chunks of one file.
+    """
+    local_codes, uniques = pd.factorize(names)
+    unique_codes = np.fromiter(
+        (name_codes.setdefault(name, len(name_codes)) for name in uniques),
+        dtype=np.int64,
+        count=len(uniques),
+    )
+    return unique_codes[local_codes]
+
+
+def best_hit_keys(df):
+    """
+    The tie-break keys of a chunk as float arrays, missing AS counts as worst.
+    """
+    return [
+        np.nan_to_num(df[key].to_numpy(np.float64), nan=-np.inf)
+        for key in BEST_HIT_KEYS
     ]
 
-    after_filter = len(df)
-    filtered_out = before_filter - after_filter
-    counts_after = df.groupby("sample").size()
 
-    # Combine into a summary table
-    per_sample_summary = (
-        pd.DataFrame({"before": counts_before, "after": counts_after})
-        .fillna(0)
-        .astype(int)
+def best_rows(groups, keys, ties=False):
+    """
+    Row index of the best hit per group (lexicographic maximum over keys, first row on
+    full ties). Uses group-wise maxima per key instead of sorting, so it runs in linear time.
+    With ties=True the indices of all rows tied with the best hit are returned as well.
+    """
+    n_groups = groups.max() + 1
+    rows = np.arange(len(groups))
+    for key in keys:
+        values = key[rows]
+        group_max = np.full(n_groups, -np.inf)
+        np.maximum.at(group_max, groups[rows], values)
+        rows = rows[values == group_max[groups[rows]]]
+
+    first = np.full(n_groups, len(groups))
+    np.minimum.at(first, groups[rows], rows)
+    if ties:
+        return first, rows
+    return first
+
+
+def new_best_hits():
+    """
+    Empty best-hit accumulator: per integer-coded query the keys and target code of its best hit.
+    """
+    return {
+        "n": 0,
+        "keys": [np.empty(0) for _ in BEST_HIT_KEYS],
+        "tname": np.empty(0, dtype=np.int64),
+    }
+
+
+def update_best_hits(best, qcodes, tcodes, keys):
+    """
+    Folds a chunk of hits into the best-hit accumulator in a single pass.
+    The chunk is first reduced to one hit per query, which then replaces the stored hit
+    only if it is lexicographically better, so earlier hits win full ties.
+    """
+    if len(qcodes) == 0:
+        return best
+
+    # Best hit per query within the chunk
+    local_groups, local_qcodes = pd.factorize(qcodes)
+    rows = best_rows(local_groups, keys)
+    chunk_keys = [key[rows] for key in keys]
+    chunk_tcodes = tcodes[rows]
+
+    # Grow the accumulator for queries seen for the first time
+    n = max(best["n"], local_qcodes.max() + 1)
+    if n > len(best["tname"]):
+        capacity = max(n, 2 * len(best["tname"]))
+        best["keys"] = [
+            np.concatenate([key, np.full(capacity - len(key), -np.inf)])
+            for key in best["keys"]
+        ]
+        best["tname"] = np.concatenate(
+            [best["tname"], np.full(capacity - len(best["tname"]), -1)]
+        )
+
+    # Lexicographic comparison against the stored best hit
+    better = local_qcodes >= best["n"]
+    decided = better.copy()
+    for new, stored in zip(chunk_keys, best["keys"]):
+        old = stored[local_qcodes]
+        better |= ~decided & (new > old)
+        decided |= new != old
+
+    winners = local_qcodes[better]
+    for stored, new in zip(best["keys"], chunk_keys):
+        stored[winners] = new[better]
+    best["tname"][winners] = chunk_tcodes[better]
+    best["n"] = n
+
+    return best
+
+
+def best_hit_counts(best, tnames):
+    """
+    Number of queries per target in the best-hit accumulator.
+    Queries without a retained hit (target code -1) are not counted.
+    """
+    best_tnames = best["tname"][: best["n"]]
+    counts = np.bincount(best_tnames[best_tnames >= 0], minlength=len(tnames))
+    return pd.Series(counts, index=tnames)[counts > 0]
+
+
+def add_target_counts(totals, tcodes, n_targets):
+    """
+    Adds the number of alignments per target code to the running totals, growing them
+    when new targets were encoded.
+    """
+    counts = np.bincount(tcodes, minlength=n_targets)
+    counts[: len(totals)] += totals
+    return counts
+
+
+def em_scores(chunk, weight):
+    """
+    Per-alignment score the EM weights are derived from: the AS tag, the identity in percent,
+    or a constant for uniform weights.
+    """
+    if weight == "AS":
+        return chunk["AS"].to_numpy(np.float32)
+    if weight == "identity":
+        return (chunk["identity"] * 100).to_numpy(np.float32)
+    return np.zeros(len(chunk), dtype=np.float32)
+
+
+def compatibility_matrix(qcodes, tcodes, scores, n_targets, scale):
+    """
+    Sparse read x target compatibility matrix (CSR) of the retained alignments.
+    Several alignments of a read to the same target are reduced to the best score, and
+    weights are exp((score - best score of the read) / scale), so the best target of each
+    read has weight 1. Missing scores get weight 1.
+    """
+    from scipy import sparse
+
+    if len(qcodes) == 0:
+        return sparse.csr_matrix((0, n_targets))
+
+    # Only reads with a retained alignment get a row
+    _, rows = np.unique(qcodes, return_inverse=True)
+
+    # Best score per read-target pair, pairs sorted by read
+    pairs = rows.astype(np.int64) * n_targets + tcodes
+    order = np.argsort(pairs, kind="stable")
+    pairs = pairs[order]
+    pair_starts = np.flatnonzero(np.r_[True, pairs[1:] != pairs[:-1]])
+    scores = np.fmax.reduceat(scores[order], pair_starts)
+    rows, cols = np.divmod(pairs[pair_starts], n_targets)
+
+    # Weights relative to the best score of each read
+    row_starts = np.flatnonzero(np.r_[True, rows[1:] != rows[:-1]])
+    read_best = np.fmax.reduceat(scores, row_starts)
+    delta = np.nan_to_num(scores - read_best[rows], nan=0.0)
+    weights = np.exp(delta / scale)
+
+    return sparse.csr_matrix(
+        (weights, cols, np.r_[row_starts, len(rows)]),
+        shape=(len(row_starts), n_targets),
     )
-    per_sample_summary["removed"] = (
-        per_sample_summary["before"] - per_sample_summary["after"]
+
+
+def em_counts(compatibility, tol=0.01, max_iter=1000):
+    """
+    Expectation-maximization estimate of the number of reads per target.
+    Each iteration assigns every read fractionally to its compatible targets in proportion to
+    weight x current abundance and re-estimates the abundances from these assignments,
+    both as sparse matrix-vector products. Stops when no target changes by more than tol reads.
+    """
+    n_reads, n_targets = compatibility.shape
+    if n_reads == 0:
+        return np.zeros(n_targets), 0
+
+    compatibility_t = compatibility.T.tocsr()
+    counts = np.full(n_targets, n_reads / n_targets)
+    for iteration in range(1, max_iter + 1):
+        read_totals = np.maximum(compatibility @ counts, np.finfo(np.float64).tiny)
+        new_counts = counts * (compatibility_t @ (1 / read_totals))
+        change = np.abs(new_counts - counts).max()
+        counts = new_counts
+        if change <= tol:
+            break
+
+    return counts, iteration
+
+
+def merge_intervals(tcodes, starts, ends):
+    """
+    Merges overlapping [start, end) intervals per target. The intervals are sorted by target
+    and start, then swept once with a running maximum of the end coordinate: an interval opens
+    a new merged block if it starts behind everything covered so far on its target.
+    Returns the merged (tcodes, starts, ends).
+    """
+    if len(tcodes) == 0:
+        return tcodes, starts, ends
+
+    order = np.lexsort((starts, tcodes))
+    tcodes, starts, ends = tcodes[order], starts[order], ends[order]
+
+    # Offsetting the ends by target keeps the running maximum from crossing target boundaries
+    offset = tcodes.astype(np.int64) * (int(ends.max()) + 1)
+    reach = np.maximum.accumulate(offset + ends) - offset
+    new_block = np.r_[True, (tcodes[1:] != tcodes[:-1]) | (starts[1:] > reach[:-1])]
+    first = np.flatnonzero(new_block)
+
+    return tcodes[first], starts[first], np.maximum.reduceat(ends, first)
+
+
+def target_breadth(intervals, target_lengths, tnames):
+    """
+    Covered bases, target length and breadth of coverage (covered fraction) per target
+    from its merged intervals.
+    """
+    tcodes, starts, ends = intervals
+    covered = np.bincount(tcodes, weights=ends - starts, minlength=len(tnames)).astype(np.int64)
+    breadth = pd.DataFrame(
+        {"tlen": target_lengths, "covered_bases": covered},
+        index=pd.Index(tnames, name="tname"),
     )
-    per_sample_summary["removed_frac_perc"] = (
-        per_sample_summary["removed"] / per_sample_summary["before"] * 100
+    breadth = breadth[breadth["covered_bases"] > 0]
+    breadth["breadth"] = breadth["covered_bases"] / breadth["tlen"]
+    return breadth
+
+
+# Reads are assigned to the LCA of all hits tied with their best hit on these keys
+LCA_TIE_KEYS = ["qcov", "AS"]
+
+
+def load_taxonomy(taxonomy_file):
+    """
+    Reads a taxonomy as parent links into arrays: a TSV with taxid and parent columns
+    (optional rank and name), or NCBI nodes.dmp (scientific names from names.dmp next to it).
+    Nodes are integer-coded, the root is its own parent. Several roots get a common virtual root.
+    """
+    taxonomy_file = Path(taxonomy_file)
+    if taxonomy_file.suffix == ".dmp":
+        nodes = pd.read_csv(
+            taxonomy_file,
+            sep="\t",
+            header=None,
+            usecols=[0, 2, 4],
+            names=["taxid", "parent", "rank"],
+            dtype=str,
+            quoting=csv.QUOTE_NONE,
+        )
+        names_file = taxonomy_file.with_name("names.dmp")
+        if names_file.exists():
+            names = pd.read_csv(
+                names_file,
+                sep="\t",
+                header=None,
+                usecols=[0, 2, 6],
+                names=["taxid", "name", "class"],
+                dtype=str,
+                quoting=csv.QUOTE_NONE,
+            )
+            names = names[names["class"] == "scientific name"].drop_duplicates("taxid")
+            nodes = nodes.merge(names[["taxid", "name"]], on="taxid", how="left")
+    else:
+        nodes = pd.read_csv(taxonomy_file, sep="\t", dtype=str)
+
+    for col in ("rank", "name"):
+        if col not in nodes.columns:
+            nodes[col] = np.nan
+    nodes["rank"] = nodes["rank"].fillna("no rank")
+    nodes["name"] = nodes["name"].fillna(nodes["taxid"])
+
+    taxids = pd.Index(nodes["taxid"])
+    parent = taxids.get_indexer(nodes["parent"])
+    roots = np.flatnonzero((parent == -1) | (parent == np.arange(len(parent))))
+    if len(roots) == 1:
+        root = roots[0]
+    else:
+        root = len(nodes)
+        nodes = pd.concat(
+            [nodes, pd.DataFrame({"taxid": ["root"], "rank": ["no rank"], "name": ["root"]})],
+            ignore_index=True,
+        )
+        parent = np.r_[parent, root]
+    parent[roots] = root
+
+    taxonomy = {
+        "taxid": nodes["taxid"].to_numpy(),
+        "name": nodes["name"].to_numpy(),
+        "rank": nodes["rank"].to_numpy(),
+        "parent": parent,
+        "root": root,
+    }
+    taxonomy.update(euler_tour(parent, root))
+    taxonomy["rmq_table"] = sparse_table(taxonomy["euler_depth"])
+    return taxonomy
+
+
+def euler_tour(parent, root):
+    """
+    Euler tour of the tree given by parent links: the node sequence of a depth-first walk
+    that records a node on entering it and after returning from every child, with the depth
+    per tour position and the first tour position of every node (-1 if unreachable).
+    """
+    n_nodes = len(parent)
+    is_child = np.arange(n_nodes) != root
+    children = np.flatnonzero(is_child)[np.argsort(parent[is_child], kind="stable")]
+    child_start = np.searchsorted(parent[children], np.arange(n_nodes + 1))
+
+    children = children.tolist()
+    next_child = child_start[:-1].tolist()
+    child_end = child_start[1:].tolist()
+
+    tour = [root]
+    depth = [0]
+    stack = [root]
+    while stack:
+        node = stack[-1]
+        if next_child[node] < child_end[node]:
+            child = children[next_child[node]]
+            next_child[node] += 1
+            stack.append(child)
+            tour.append(child)
+            depth.append(len(stack) - 1)
+        else:
+            stack.pop()
+            if stack:
+                tour.append(stack[-1])
+                depth.append(len(stack) - 1)
+
+    tour = np.array(tour, dtype=np.int64)
+    first = np.full(n_nodes, -1, dtype=np.int64)
+    positions = np.arange(len(tour))
+    # Writing in reverse order leaves the first position of every node
+    first[tour[::-1]] = positions[::-1]
+
+    return {
+        "euler": tour,
+        "euler_depth": np.array(depth, dtype=np.int32),
+        "euler_first": first,
+    }
+
+
+def sparse_table(values):
+    """
+    Sparse table for range-minimum queries: level k holds, for every start position,
+    the position of the minimum over the 2**k values starting there.
+    """
+    table = [np.arange(len(values), dtype=np.int32)]
+    width = 1
+    while 2 * width <= len(values):
+        prev = table[-1]
+        left = prev[: len(values) - 2 * width + 1]
+        right = prev[width : width + len(left)]
+        table.append(np.where(values[left] <= values[right], left, right))
+        width *= 2
+    return table
+
+
+def range_minimum(table, values, lo, hi):
+    """
+    Position of the minimum of values[lo..hi] (inclusive) for arrays of ranges, each answered
+    in O(1) from two overlapping power-of-two blocks of the sparse table.
+    """
+    level = np.floor(np.log2(hi - lo + 1)).astype(np.int64)
+    result = np.empty(len(lo), dtype=np.int64)
+    for k in np.unique(level):
+        in_level = level == k
+        left = table[k][lo[in_level]]
+        right = table[k][hi[in_level] - (1 << k) + 1]
+        result[in_level] = np.where(values[left] <= values[right], left, right)
+    return result
+
+
+def lca_nodes(taxonomy, lo, hi):
+    """
+    Lowest common ancestor of the nodes whose first Euler positions span lo..hi:
+    the shallowest node visited by the tour in between.
+    """
+    positions = range_minimum(taxonomy["rmq_table"], taxonomy["euler_depth"], lo, hi)
+    return taxonomy["euler"][positions]
+
+
+def rank_ancestors(taxonomy, nodes, rank):
+    """
+    Ancestor (or the node itself) of the given rank per node, -1 if there is none.
+    Walks all nodes up one level per step.
+    """
+    parent = taxonomy["parent"]
+    ancestors = nodes.copy()
+    result = np.full(len(nodes), -1, dtype=np.int64)
+    active = np.ones(len(nodes), dtype=bool)
+    while active.any():
+        found = active & (taxonomy["rank"][ancestors] == rank)
+        result[found] = ancestors[found]
+        active &= ~found & (ancestors != taxonomy["root"])
+        ancestors[active] = parent[ancestors[active]]
+    return result
+
+
+def new_lca_hits():
+    """
+    Empty LCA accumulator: per integer-coded query the keys of its best hit and the
+    range of Euler first positions spanned by the targets of all hits tied with it.
+    """
+    return {
+        "n": 0,
+        "keys": [np.empty(0) for _ in LCA_TIE_KEYS],
+        "lo": np.empty(0, dtype=np.int64),
+        "hi": np.empty(0, dtype=np.int64),
+    }
+
+
+def update_lca_hits(lca, qcodes, positions, keys):
+    """
+    Folds a chunk of hits into the LCA accumulator. A better hit replaces the stored
+    Euler range of the query, a tied hit widens it.
+    """
+    if len(qcodes) == 0:
+        return lca
+
+    # Best keys and Euler range of the tied hits per query within the chunk
+    local_groups, local_qcodes = pd.factorize(qcodes)
+    rows, tied = best_rows(local_groups, keys, ties=True)
+    chunk_keys = [key[rows] for key in keys]
+    chunk_lo = np.full(len(local_qcodes), np.iinfo(np.int64).max)
+    chunk_hi = np.full(len(local_qcodes), -1, dtype=np.int64)
+    np.minimum.at(chunk_lo, local_groups[tied], positions[tied])
+    np.maximum.at(chunk_hi, local_groups[tied], positions[tied])
+
+    # Grow the accumulator for queries seen for the first time
+    n = max(lca["n"], local_qcodes.max() + 1)
+    if n > len(lca["lo"]):
+        capacity = max(n, 2 * len(lca["lo"]))
+        grow = capacity - len(lca["lo"])
+        lca["keys"] = [np.concatenate([key, np.full(grow, -np.inf)]) for key in lca["keys"]]
+        lca["lo"] = np.concatenate([lca["lo"], np.full(grow, np.iinfo(np.int64).max)])
+        lca["hi"] = np.concatenate([lca["hi"], np.full(grow, -1, dtype=np.int64)])
+
+    # Lexicographic comparison against the stored best keys
+    better = local_qcodes >= lca["n"]
+    decided = better.copy()
+    for new, stored in zip(chunk_keys, lca["keys"]):
+        old = stored[local_qcodes]
+        better |= ~decided & (new > old)
+        decided |= new != old
+    tied_best = ~decided
+
+    winners = local_qcodes[better]
+    for stored, new in zip(lca["keys"], chunk_keys):
+        stored[winners] = new[better]
+    lca["lo"][winners] = chunk_lo[better]
+    lca["hi"][winners] = chunk_hi[better]
+
+    equal = local_qcodes[tied_best]
+    lca["lo"][equal] = np.minimum(lca["lo"][equal], chunk_lo[tied_best])
+    lca["hi"][equal] = np.maximum(lca["hi"][equal], chunk_hi[tied_best])
+    lca["n"] = n
+
+    return lca
+
+
+def lca_ranges(lca):
+    """
+    Distinct Euler ranges of the queries in the LCA accumulator with their number of queries.
+    Only these ranges are sent back from the workers, the LCA is resolved in the main process.
+    """
+    hi = lca["hi"][: lca["n"]]
+    assigned = hi >= 0
+    ranges, reads = np.unique(
+        np.column_stack([lca["lo"][: lca["n"]][assigned], hi[assigned]]), axis=0, return_counts=True
     )
+    return pd.DataFrame({"lo": ranges[:, 0], "hi": ranges[:, 1], "reads": reads})
 
-    print("\nPer-sample filtering summary:")
-    print(per_sample_summary.to_string())
 
+def process_paf(
+    paf_file,
+    settings,
+    chunksize=1_000_000,
+    cache=False,
+    em_weight=None,
+    em_scale=5.0,
+    em_tol=0.01,
+    em_max_iter=1000,
+    breadth=False,
+    target_positions=None,
+):
+    """
+    Streams one PAF file chunk by chunk and folds every chunk into small per-sample accumulators:
+    the number of alignments before/after filtering, the retained alignments per target
+    (multimappers included) and the best hit per integer-coded query.
+    settings is a list of (cov, id, mapq) thresholds, all evaluated on the same pass with one
+    boolean mask each; the accumulators are returned per setting, in the same order.
+    Rejected rows and processed chunks are never kept, only the accumulators are returned.
+    With cache=True the parsed columns are read from (or written to) a Feather cache.
+    With em_weight (AS, identity or uniform) the retained alignments are also kept as compact
+    (read, target, score) arrays and the reads per target are estimated by EM.
+    With breadth=True the target intervals of the retained alignments are merged after every
+    chunk, which gives the breadth of coverage per target.
+    With target_positions (tname -> first Euler position of its taxon) every query also keeps
+    the Euler range of its equally-best hits, which resolves to their lowest common ancestor.
+    """
+    n_before = 0
+    qname_codes = {}
+    tname_codes = {}
+    target_lengths = np.zeros(0, dtype=np.int64)
+    tcode_positions = np.zeros(0, dtype=np.int64)
+    accumulators = [
+        {
+            "after": 0,
+            "multi": np.zeros(0, dtype=np.int64),
+            "best": new_best_hits(),
+            "em": ([], [], []),
+            "intervals": (
+                np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.int64),
+                np.empty(0, dtype=np.int64),
+            ),
+            "lca": new_lca_hits(),
+        }
+        for _ in settings
+    ]
+    histograms = {col: np.zeros(len(edges) - 1, dtype=np.int64) for col, edges in HIST_BINS.items()}
+
+    chunks = cached_paf_chunks(paf_file, chunksize) if cache else read_paf_chunks(paf_file, chunksize)
+
+    for chunk in chunks:
+        n_before += len(chunk)
+        for col, counts in histogram_counts(chunk).items():
+            histograms[col] += counts
+
+        # Rows rejected by every setting are dropped before the names are encoded
+        masks = filter_masks(chunk, settings)
+        keep = np.logical_or.reduce(masks)
+        chunk = chunk[keep]
+
+        qcodes = encode_names(chunk["qname"], qname_codes)
+        tcodes = encode_names(chunk["tname"], tname_codes)
+        keys = best_hit_keys(chunk)
+        scores = em_scores(chunk, em_weight) if em_weight else None
+
+        if breadth:
+            grown = np.zeros(len(tname_codes), dtype=np.int64)
+            grown[: len(target_lengths)] = target_lengths
+            target_lengths = grown
+            np.maximum.at(target_lengths, tcodes, chunk["tlen"].to_numpy(np.int64))
+            tstarts = chunk["tstart"].to_numpy(np.int64)
+            tends = chunk["tend"].to_numpy(np.int64)
+
+        if target_positions is not None:
+            # Euler positions of newly encoded targets, -1 for targets without a taxon
+            new_targets = islice(tname_codes, len(tcode_positions), None)
+            tcode_positions = np.r_[
+                tcode_positions,
+                np.fromiter((target_positions.get(t, -1) for t in new_targets), dtype=np.int64),
+            ]
+            positions = tcode_positions[tcodes]
+            lca_keys = [keys[BEST_HIT_KEYS.index(key)] for key in LCA_TIE_KEYS]
+
+        for acc, mask in zip(accumulators, masks):
+            mask = mask[keep]
+            acc["after"] += int(mask.sum())
+            acc["multi"] = add_target_counts(acc["multi"], tcodes[mask], len(tname_codes))
+            acc["best"] = update_best_hits(
+                acc["best"], qcodes[mask], tcodes[mask], [key[mask] for key in keys]
+            )
+            if em_weight:
+                em_q, em_t, em_s = acc["em"]
+                em_q.append(qcodes[mask].astype(np.int32))
+                em_t.append(tcodes[mask].astype(np.int32))
+                em_s.append(scores[mask])
+            if breadth:
+                # Merging after every chunk keeps only the disjoint covered blocks in memory
+                acc["intervals"] = merge_intervals(
+                    *(
+                        np.concatenate([stored, new[mask]])
+                        for stored, new in zip(acc["intervals"], (tcodes, tstarts, tends))
+                    )
+                )
+            if target_positions is not None:
+                lca_mask = mask & (positions >= 0)
+                acc["lca"] = update_lca_hits(
+                    acc["lca"], qcodes[lca_mask], positions[lca_mask], [key[lca_mask] for key in lca_keys]
+                )
+
+    tnames = np.array(list(tname_codes), dtype=object)
+    setting_results = []
+    for acc in accumulators:
+        best_tnames = acc["best"]["tname"][: acc["best"]["n"]]
+        multi = np.zeros(len(tnames), dtype=np.int64)
+        multi[: len(acc["multi"])] = acc["multi"]
+        setting_result = {
+            "after": acc["after"],
+            "reads": int((best_tnames >= 0).sum()),
+            "multi_counts": pd.Series(multi, index=tnames)[multi > 0],
+            "best_counts": best_hit_counts(acc["best"], tnames),
+        }
+
+        if em_weight:
+            em_q, em_t, em_s = (
+                np.concatenate(parts) if parts else np.empty(0, dtype=np.int32)
+                for parts in acc["em"]
+            )
+            acc["em"] = None
+            compatibility = compatibility_matrix(em_q, em_t, em_s, len(tnames), em_scale)
+            counts, iterations = em_counts(compatibility, em_tol, em_max_iter)
+            setting_result["em_counts"] = pd.Series(counts, index=tnames)[counts > 0]
+            setting_result["em_iterations"] = iterations
+
+        if breadth:
+            setting_result["breadth"] = target_breadth(acc["intervals"], target_lengths, tnames)
+
+        if target_positions is not None:
+            setting_result["lca_ranges"] = lca_ranges(acc["lca"])
+
+        setting_results.append(setting_result)
+
+    return {
+        "sample": Path(paf_file).stem,
+        "before": n_before,
+        "histograms": histograms,
+        "settings": setting_results,
+    }
+
+
+def select_setting(results, index):
+    """
+    Per-sample results of one threshold setting, in the layout counts_to_long expects.
+    """
+    return [
+        {"sample": result["sample"], "before": result["before"], **result["settings"][index]}
+        for result in results
+    ]
+
+
+def counts_to_long(results, key):
+    """
+    Combines the per-sample count accumulators into a long table (sample, tname, reads).
+    """
+    counts = [
+        result[key].rename("reads").rename_axis("tname").reset_index().assign(sample=result["sample"])
+        for result in results
+    ]
+    return pd.concat(counts, ignore_index=True)[["sample", "tname", "reads"]]
+
+
+def write_dense_tables(counts, counts_multi, taxon_df, output_folder):
+    """
+    Pivots the long best-hit and multimapper counts into dense OTU tables on genome and genus rank.
+    """
     # ------------------- Generate table including multimappers ------------------ #
-    # Count reads per target
-    counts_multi = df.groupby(["sample", "tname"]).size().reset_index(name="reads")
     otu_table_multi = (
         counts_multi.pivot(index="tname", columns="sample", values="reads")
         .fillna(0)
@@ -222,57 +1132,6 @@ def main():
     ).set_index("tname")
 
     # -------------------- Generate table with best-hits only -------------------- #
-    # Select best hit per query (highest qcov, then highest AS, highest mapq, longest aln as tie breaker)
-    df_best = df.sort_values(
-        ["qname", "qcov", "AS", "mapq", "alen"],
-        ascending=[True, False, False, False, False],
-    ).drop_duplicates("qname")
-
-    # Count reads per target
-    counts = df_best.groupby(["sample", "tname"]).size().reset_index(name="reads")
-
-    # Add unmapped reads if stats are provided
-    if stats_path and stats_path.exists():
-        stats = pd.read_csv(stats_path, sep="\t")
-
-        # Derive sample names from the stats file, more flexibly
-        stats["sample"] = stats["file"].apply(lambda x: Path(x).stem)
-
-        # Create sample name lists from both sources
-        paf_samples = counts["sample"].unique().tolist()
-        stats_samples = stats["sample"].unique().tolist()
-
-        # Try to match samples even if names differ slightly
-        matched_samples = {}
-        for paf_s in paf_samples:
-            for stats_s in stats_samples:
-                # A simple heuristic: if paf_s is contained in stats_s or vice versa
-                if paf_s in stats_s or stats_s in paf_s:
-                    matched_samples[stats_s] = paf_s
-                    break
-
-        # Apply mapping if matches found
-        if matched_samples:
-            stats["sample"] = stats["sample"].replace(matched_samples)
-        else:
-            print(
-                "Warning: No matching samples found between PAF and stats files. Check naming consistency."
-            )
-        
-        # Generate count table but including the info from stats
-        mapped_seqs = counts.groupby("sample")["reads"].sum()
-        barcode_total_seqs = stats.groupby("sample")["num_seqs"].sum()
-        unmapped_seqs = (barcode_total_seqs - mapped_seqs).reset_index()
-        unmapped_seqs.columns = ["sample", "reads"]
-        unmapped_seqs["tname"] = "unassigned"
-        unmapped_seqs = unmapped_seqs[["sample", "tname", "reads"]]
-
-        counts = pd.concat([counts, unmapped_seqs], ignore_index=True)
-
-    else:
-        print(f"{stats_path} not provided or does not exist")
-
-    # Generate OTU table
     otu_table = (
         counts.pivot(index="tname", columns="sample", values="reads")
         .fillna(0)
@@ -301,7 +1160,6 @@ def main():
         .astype(int)
     )
 
-    # ------------------------------- Write to file ------------------------------ #
     otu_table_tax.to_csv(output_folder / "otu_table.tsv", sep="\t")
     otu_table_multi_tax.to_csv(output_folder / "otu_table_multimappers.tsv", sep="\t")
     otu_table_genus.to_csv(output_folder / "otu_table_genus.tsv", sep="\t")
@@ -311,5 +1169,589 @@ def main():
     )
 
 
+def long_to_sparse(counts, row_col, col_col="sample", value_col="reads"):
+    """
+    Accumulates a long count table as COO triplets and converts it to a CSR matrix
+    (rows: row_col, columns: col_col, both sorted). Duplicate entries are summed.
+    """
+    from scipy import sparse
+
+    rows, row_names = pd.factorize(counts[row_col], sort=True)
+    cols, col_names = pd.factorize(counts[col_col], sort=True)
+    matrix = sparse.coo_matrix(
+        (counts[value_col].to_numpy(), (rows, cols)),
+        shape=(len(row_names), len(col_names)),
+    ).tocsr()
+
+    return matrix, pd.Index(row_names, name=row_col), pd.Index(col_names, name=col_col)
+
+
+def genus_indicator(targets, taxon_df):
+    """
+    Sparse genus x target indicator matrix, targets without a genus go to "unassigned".
+    """
+    from scipy import sparse
+
+    genus = (
+        taxon_df.drop_duplicates("tname")
+        .set_index("tname")["genus"]
+        .reindex(targets)
+        .fillna("unassigned")
+    )
+    genus_codes, genera = pd.factorize(genus, sort=True)
+    indicator = sparse.csr_matrix(
+        (np.ones(len(targets), dtype=np.int64), (genus_codes, np.arange(len(targets)))),
+        shape=(len(genera), len(targets)),
+    )
+
+    return indicator, pd.Index(genera, name="genus"), genus
+
+
+def write_sparse_matrix(matrix, rows, col_names, prefix, formats):
+    """
+    Writes a sparse count matrix as Matrix Market, long-format Parquet, NPZ and/or HDF5.
+    rows is a table with one line per matrix row, its first column holds the row names.
+    Rows and column names are written next to it as <prefix>_rows.tsv and <prefix>_samples.tsv.
+    """
+    from scipy import io, sparse
+
+    prefix = str(prefix)
+    written = []
+    rows.to_csv(f"{prefix}_rows.tsv", sep="\t", index=False)
+    col_names.to_frame(index=False).to_csv(f"{prefix}_samples.tsv", sep="\t", index=False)
+    row_col = rows.columns[0]
+
+    if "mtx" in formats:
+        field = "integer" if matrix.dtype.kind in "iu" else "real"
+        io.mmwrite(f"{prefix}.mtx", matrix.tocoo(), field=field)
+        written.append(f"{prefix}.mtx")
+
+    if "parquet" in formats:
+        coo = matrix.tocoo()
+        long_table = pd.concat(
+            [
+                rows.iloc[coo.row].reset_index(drop=True),
+                pd.DataFrame(
+                    {col_names.name: np.asarray(col_names)[coo.col], "reads": coo.data}
+                ),
+            ],
+            axis=1,
+        )
+        long_table.to_parquet(f"{prefix}.parquet", index=False)
+        written.append(f"{prefix}.parquet")
+
+    if "npz" in formats:
+        sparse.save_npz(f"{prefix}.npz", matrix.tocsr())
+        written.append(f"{prefix}.npz")
+
+    if "h5" in formats:
+        import h5py
+
+        csr = matrix.tocsr()
+        with h5py.File(f"{prefix}.h5", "w") as h5:
+            h5.create_dataset("data", data=csr.data, compression="gzip")
+            h5.create_dataset("indices", data=csr.indices, compression="gzip")
+            h5.create_dataset("indptr", data=csr.indptr, compression="gzip")
+            h5.create_dataset("shape", data=csr.shape)
+            for col in rows.columns:
+                h5.create_dataset(f"rows/{col}", data=rows[col].astype(str).to_numpy().astype(bytes))
+            h5.create_dataset("samples", data=np.asarray(col_names).astype(str).astype(bytes))
+        written.append(f"{prefix}.h5")
+
+    return written
+
+
+def write_sparse_tables(counts, counts_multi, taxon_df, output_folder, formats):
+    """
+    Builds the OTU tables as sparse target x sample matrices without any dense pivot.
+    The genus table is a sparse product of a genus x target indicator matrix and the target counts.
+    """
+    written = []
+
+    # Best hits on genome rank, row names carry the genus
+    otu_matrix, targets, samples = long_to_sparse(counts, "tname")
+    indicator, genera, target_genus = genus_indicator(targets, taxon_df)
+    target_rows = pd.DataFrame({"tname": targets, "genus": target_genus.to_numpy()})
+    written += write_sparse_matrix(
+        otu_matrix, target_rows, samples, output_folder / "otu_table", formats
+    )
+
+    # Multimappers on genome rank
+    multi_matrix, multi_targets, multi_samples = long_to_sparse(counts_multi, "tname")
+    written += write_sparse_matrix(
+        multi_matrix, multi_targets.to_frame(index=False), multi_samples, output_folder / "otu_table_multimappers", formats
+    )
+
+    # Genus rank: roll up with a sparse matrix product instead of merge + groupby
+    genus_matrix = indicator @ otu_matrix
+    written += write_sparse_matrix(
+        genus_matrix, genera.to_frame(index=False), samples, output_folder / "otu_table_genus", formats
+    )
+
+    print(f"\nSparse OTU tables written: {', '.join(Path(f).name for f in written)}")
+
+
+def write_em_tables(counts_em, taxon_df, output_folder, formats=None):
+    """
+    Writes the fractional EM read counts on genome and genus rank, dense or sparse.
+    """
+    if formats:
+        em_matrix, targets, samples = long_to_sparse(counts_em, "tname")
+        indicator, genera, target_genus = genus_indicator(targets, taxon_df)
+        target_rows = pd.DataFrame({"tname": targets, "genus": target_genus.to_numpy()})
+        written = write_sparse_matrix(
+            em_matrix, target_rows, samples, output_folder / "otu_table_em", formats
+        )
+        written += write_sparse_matrix(
+            indicator @ em_matrix, genera.to_frame(index=False), samples, output_folder / "otu_table_em_genus", formats
+        )
+        print(f"\nSparse EM tables written: {', '.join(Path(f).name for f in written)}")
+        return
+
+    otu_table_em = (
+        counts_em.pivot(index="tname", columns="sample", values="reads")
+        .fillna(0)
+        .round(3)
+    )
+    otu_table_em_tax = taxon_df.merge(otu_table_em, on="tname", how="right").set_index(
+        "tname"
+    )
+    otu_table_em_tax["genus"] = otu_table_em_tax["genus"].fillna("unassigned")
+
+    otu_table_em_genus = (
+        counts_em.merge(taxon_df, on="tname", how="left")
+        .fillna({"genus": "unassigned"})
+        .groupby(["genus", "sample"])["reads"]
+        .sum()
+        .unstack(fill_value=0)
+        .round(3)
+    )
+
+    otu_table_em_tax.to_csv(output_folder / "otu_table_em.tsv", sep="\t")
+    otu_table_em_genus.to_csv(output_folder / "otu_table_em_genus.tsv", sep="\t")
+
+    print(f"\notu_table_em.tsv and otu_table_em_genus.tsv written to {output_folder}")
+
+
+def target_euler_positions(taxonomy, target_taxids_file):
+    """
+    First Euler position of the taxon of every target, targets with a taxid missing from
+    the taxonomy are left out (their hits are ignored by the LCA).
+    """
+    target_taxids = pd.read_csv(target_taxids_file, sep="\t", dtype=str)
+    if "tname" not in target_taxids.columns:
+        target_taxids.columns = ["tname", "taxid"]
+
+    nodes = pd.Index(taxonomy["taxid"]).get_indexer(target_taxids["taxid"])
+    known = nodes >= 0
+    if not known.all():
+        print(f"Warning: {(~known).sum()} targets have a taxid that is not in the taxonomy")
+
+    return dict(
+        zip(target_taxids["tname"][known], taxonomy["euler_first"][nodes[known]].tolist())
+    )
+
+
+def write_lca_tables(results, taxonomy, ranks, output_folder):
+    """
+    Resolves the Euler ranges of every sample to LCA nodes and writes the reads per LCA node
+    (otu_table_lca.tsv) and, per rank, the reads whose LCA lies at or below a node of that rank
+    summed to that node (otu_table_lca_<rank>.tsv). Reads with an LCA above the rank are unassigned.
+    """
+    counts_lca = []
+    for result in results:
+        ranges = result["lca_ranges"]
+        nodes = lca_nodes(taxonomy, ranges["lo"].to_numpy(), ranges["hi"].to_numpy())
+        counts_lca.append(
+            pd.DataFrame({"node": nodes, "reads": ranges["reads"].to_numpy()})
+            .groupby("node", as_index=False)["reads"]
+            .sum()
+            .assign(sample=result["sample"])
+        )
+    counts_lca = pd.concat(counts_lca, ignore_index=True)
+
+    otu_table_lca = (
+        counts_lca.pivot(index="node", columns="sample", values="reads").fillna(0).astype(int)
+    )
+    nodes = otu_table_lca.index.to_numpy()
+    otu_table_lca.insert(0, "rank", taxonomy["rank"][nodes])
+    otu_table_lca.insert(0, "name", taxonomy["name"][nodes])
+    otu_table_lca.index = pd.Index(taxonomy["taxid"][nodes], name="taxid")
+    otu_table_lca.to_csv(output_folder / "otu_table_lca.tsv", sep="\t")
+    written = ["otu_table_lca.tsv"]
+
+    for rank in ranks:
+        ancestors = rank_ancestors(taxonomy, counts_lca["node"].to_numpy(), rank)
+        assigned = ancestors >= 0
+        ancestors = np.where(assigned, ancestors, 0)
+        counts_rank = counts_lca.assign(
+            taxid=np.where(assigned, taxonomy["taxid"][ancestors], "unassigned"),
+            name=np.where(assigned, taxonomy["name"][ancestors], "unassigned"),
+        )
+        otu_table_rank = (
+            counts_rank.groupby(["taxid", "name", "sample"])["reads"]
+            .sum()
+            .unstack(fill_value=0)
+            .reset_index("name")
+        )
+        otu_table_rank.to_csv(output_folder / f"otu_table_lca_{rank}.tsv", sep="\t")
+        written.append(f"otu_table_lca_{rank}.tsv")
+
+    print(f"\n{', '.join(written)} written to {output_folder}")
+
+
+def add_unassigned(counts, stats_path):
+    """
+    Adds an "unassigned" row per sample (total reads from the seqkit stats minus best-hit reads)
+    if stats are provided.
+    """
+    if not (stats_path and stats_path.exists()):
+        print(f"{stats_path} not provided or does not exist")
+        return counts
+
+    stats = pd.read_csv(stats_path, sep="\t")
+
+    # Derive sample names from the stats file, more flexibly
+    stats["sample"] = stats["file"].apply(lambda x: Path(x).stem)
+
+    # Create sample name lists from both sources
+    paf_samples = counts["sample"].unique().tolist()
+    stats_samples = stats["sample"].unique().tolist()
+
+    # Try to match samples even if names differ slightly
+    matched_samples = {}
+    for paf_s in paf_samples:
+        for stats_s in stats_samples:
+            # A simple heuristic: if paf_s is contained in stats_s or vice versa
+            if paf_s in stats_s or stats_s in paf_s:
+                matched_samples[stats_s] = paf_s
+                break
+
+    # Apply mapping if matches found
+    if matched_samples:
+        stats["sample"] = stats["sample"].replace(matched_samples)
+    else:
+        print(
+            "Warning: No matching samples found between PAF and stats files. Check naming consistency."
+        )
+
+    # Generate count table but including the info from stats
+    mapped_seqs = counts.groupby("sample")["reads"].sum()
+    barcode_total_seqs = stats.groupby("sample")["num_seqs"].sum()
+    unmapped_seqs = (barcode_total_seqs - mapped_seqs).reset_index()
+    unmapped_seqs.columns = ["sample", "reads"]
+    unmapped_seqs["tname"] = "unassigned"
+    unmapped_seqs = unmapped_seqs[["sample", "tname", "reads"]]
+
+    return pd.concat([counts, unmapped_seqs], ignore_index=True)
+
+
+def breadth_to_long(results):
+    """
+    Combines the per-sample breadth of coverage into a long table.
+    """
+    breadth = [
+        result["breadth"].reset_index().assign(sample=result["sample"]) for result in results
+    ]
+    return pd.concat(breadth, ignore_index=True)[
+        ["sample", "tname", "tlen", "covered_bases", "breadth"]
+    ]
+
+
+def apply_min_breadth(results, min_breadth):
+    """
+    Removes the counts of targets covered below min_breadth, per sample.
+    """
+    filtered = []
+    for result in results:
+        covered = result["breadth"].index[result["breadth"]["breadth"] >= min_breadth]
+        result = dict(result)
+        for key in ("multi_counts", "best_counts", "em_counts"):
+            if key in result:
+                result[key] = result[key][result[key].index.isin(covered)]
+        filtered.append(result)
+    return filtered
+
+
+def write_otu_tables(
+    results,
+    taxon_df,
+    stats_path,
+    output_folder,
+    sparse_format=None,
+    min_breadth=None,
+    taxonomy=None,
+    lca_ranks=(),
+):
+    """
+    Writes the best-hit and multimapper OTU tables of one threshold setting.
+    """
+    # ----------------------- Breadth of coverage per target ---------------------- #
+    if "breadth" in results[0]:
+        breadth_to_long(results).sort_values(["sample", "tname"]).to_csv(
+            output_folder / "target_breadth.tsv", sep="\t", index=False
+        )
+
+        # Drop targets whose hits pile up on a small part of the genome
+        if min_breadth is not None:
+            results = apply_min_breadth(results, min_breadth)
+
+    # ------------------- Count reads including multimappers ------------------- #
+    # Count reads per target
+    counts_multi = counts_to_long(results, "multi_counts")
+
+    # -------------------- Count reads with best-hits only -------------------- #
+    # Best hit per query was selected per sample while streaming
+    # (highest qcov, then highest AS, highest mapq, longest aln as tie breaker)
+    counts = counts_to_long(results, "best_counts")
+
+    # Add unmapped reads if stats are provided
+    counts = add_unassigned(counts, stats_path)
+
+    # ------------------------------- Write to file ------------------------------ #
+    if sparse_format:
+        write_sparse_tables(counts, counts_multi, taxon_df, output_folder, sparse_format)
+    else:
+        write_dense_tables(counts, counts_multi, taxon_df, output_folder)
+
+    # -------------- Fractional counts from the EM over multimappers -------------- #
+    if "em_counts" in results[0]:
+        counts_em = counts_to_long(results, "em_counts")
+        write_em_tables(counts_em, taxon_df, output_folder, sparse_format)
+        iterations = {result["sample"]: result["em_iterations"] for result in results}
+        print(f"EM iterations per sample: {iterations}")
+
+    # ------------------ Lowest common ancestor of equally-best hits --------------- #
+    if taxonomy is not None:
+        write_lca_tables(results, taxonomy, lca_ranks, output_folder)
+
+
+def setting_label(setting):
+    """
+    Folder name of a (cov, id, mapq) setting, e.g. cov0.9_id0.95_mapq30.
+    """
+    cov, identity, mapq = setting
+    return f"cov{cov:g}_id{identity:g}_mapq{mapq}"
+
+
+def write_sweep(
+    results,
+    settings,
+    taxon_df,
+    stats_path,
+    output_folder,
+    sparse_format=None,
+    min_breadth=None,
+    taxonomy=None,
+    lca_ranks=(),
+):
+    """
+    Writes the OTU tables of every threshold setting into <output_folder>/sweep/<setting>/
+    and a long summary (sweep_summary.tsv) with the alignments and reads retained
+    per sample and setting.
+    """
+    sweep_folder = output_folder / "sweep"
+    summary = []
+    for index, setting in enumerate(settings):
+        setting_results = select_setting(results, index)
+
+        setting_folder = sweep_folder / setting_label(setting)
+        setting_folder.mkdir(parents=True, exist_ok=True)
+        write_otu_tables(
+            setting_results,
+            taxon_df,
+            stats_path,
+            setting_folder,
+            sparse_format,
+            min_breadth,
+            taxonomy,
+            lca_ranks,
+        )
+
+        cov, identity, mapq = setting
+        summary += [
+            {
+                "cov": cov,
+                "id": identity,
+                "mapq": mapq,
+                "sample": result["sample"],
+                "alignments_before": result["before"],
+                "alignments_after": result["after"],
+                "reads_retained": result["reads"],
+            }
+            for result in setting_results
+        ]
+
+    summary = pd.DataFrame(summary).sort_values(["cov", "id", "mapq", "sample"])
+    summary["alignments_removed_frac_perc"] = (
+        (summary["alignments_before"] - summary["alignments_after"])
+        / summary["alignments_before"]
+        * 100
+    )
+    summary.to_csv(output_folder / "sweep_summary.tsv", sep="\t", index=False)
+
+    print("\nReads retained per setting (summed over samples):")
+    print(summary.groupby(["cov", "id", "mapq"])["reads_retained"].sum().to_string())
+
+
+def main():
+    # ----------------------------- Define parameters ---------------------------- #
+    args = parse_args()
+    input_folder = Path(args.input_folder)
+    taxon_path = Path(args.taxa_mapping)
+    stats_path = Path(args.stats_file) if args.stats_file else None
+
+    coverage_threshold = args.cov
+    identity_threshold = args.id
+    mapq_threshold = args.mapq
+
+    output_folder = Path(args.output_folder)
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    # For testing (change to true for testing)
+    if False:
+        input_folder = Path("data_analysis/results/minimap2/")
+        taxon_path = Path("data/accession_to_genus.tsv")
+        stats_path = Path("data_analysis/results/seqkit/fastq_filtered.tsv")
+        output_folder = Path("data_analysis/results")
+        coverage_threshold = 0.9  # minimum fraction of query covered
+        identity_threshold = (
+            0.9  # optional, if computing identity from AS/optional tags
+        )
+        mapq_threshold = 30
+
+    # ------------------------------- Read in taxa info --------------------------- #
+    taxon_df = pd.read_csv(taxon_path, sep="\t")
+    if "tname" not in taxon_df.columns:
+        taxon_df.columns = ["tname", "genus"]
+
+    # ------------------- Read in taxonomy for the LCA mode ---------------------- #
+    taxonomy = None
+    target_positions = None
+    if args.taxonomy:
+        if not args.target_taxids:
+            sys.exit("--taxonomy needs --target_taxids. Exiting.")
+        taxonomy = load_taxonomy(args.taxonomy)
+        target_positions = target_euler_positions(taxonomy, args.target_taxids)
+
+    # ------------------------- Read in and filter PAFs ------------------------- #
+    all_files = list(input_folder.glob("*.paf"))
+
+    # Each file is streamed in chunks and reduced to per-sample accumulators,
+    # so memory does not scale with the total number of alignments
+    # Sweep mode evaluates every (cov, id, mapq) combination on the same pass over the PAFs
+    sweep = bool(args.sweep_cov or args.sweep_id or args.sweep_mapq)
+    settings = threshold_grid(
+        args.sweep_cov or [coverage_threshold],
+        args.sweep_id or [identity_threshold],
+        args.sweep_mapq or [mapq_threshold],
+    )
+
+    process_file = partial(
+        process_paf,
+        settings=settings,
+        chunksize=args.chunksize,
+        cache=args.cache,
+        em_weight=args.em,
+        em_scale=args.em_scale,
+        em_tol=args.em_tol,
+        em_max_iter=args.em_max_iter,
+        breadth=args.breadth or args.min_breadth is not None,
+        target_positions=target_positions,
+    )
+
+    if args.threads > 1 and len(all_files) > 1:
+        # Files are independent: parse them in worker processes, largest first, so the
+        # run takes roughly as long as the largest file. Only the accumulators are sent back
+        all_files = sorted(all_files, key=lambda f: f.stat().st_size, reverse=True)
+        with Pool(min(args.threads, len(all_files))) as pool:
+            results = list(pool.imap_unordered(process_file, all_files))
+    else:
+        results = [process_file(paf_file) for paf_file in all_files]
+
+    if not results:
+        sys.exit("No PAF files found in input folder. Exiting.")
+
+    # Visualize the data distribution of key parameters (before filtering)
+    # Histograms were binned while streaming, here only the counts are combined and drawn
+    histograms = {
+        result["sample"]: result["histograms"]
+        for result in sorted(results, key=lambda result: result["sample"])
+    }
+    histograms["all"] = {
+        col: sum(sample_counts[col] for sample_counts in histograms.values())
+        for col in HIST_BINS
+    }
+    histograms_to_long(histograms).to_csv(
+        output_folder / "diagnostic_histograms.tsv", sep="\t", index=False
+    )
+
+    if not args.no_plots:
+        for col in HIST_BINS:
+            plot_histogram(histograms["all"][col], col, col, output_folder / f"{col}_hist.png")
+
+        if args.per_sample_plots:
+            hist_folder = output_folder / "histograms"
+            hist_folder.mkdir(exist_ok=True)
+            for sample, sample_counts in histograms.items():
+                if sample == "all":
+                    continue
+                for col in HIST_BINS:
+                    plot_histogram(
+                        sample_counts[col],
+                        col,
+                        f"{sample}: {col}",
+                        hist_folder / f"{sample}_{col}_hist.png",
+                    )
+
+    if sweep:
+        write_sweep(
+            results,
+            settings,
+            taxon_df,
+            stats_path,
+            output_folder,
+            args.sparse_format,
+            args.min_breadth,
+            taxonomy,
+            args.lca_ranks,
+        )
+        return
+
+    results = select_setting(results, 0)
+
+    # Combine into a summary table
+    per_sample_summary = (
+        pd.DataFrame(
+            {
+                "sample": [result["sample"] for result in results],
+                "before": [result["before"] for result in results],
+                "after": [result["after"] for result in results],
+            }
+        )
+        .set_index("sample")
+        .sort_index()
+    )
+    per_sample_summary["removed"] = (
+        per_sample_summary["before"] - per_sample_summary["after"]
+    )
+    per_sample_summary["removed_frac_perc"] = (
+        per_sample_summary["removed"] / per_sample_summary["before"] * 100
+    )
+
+    print("\nPer-sample filtering summary:")
+    print(per_sample_summary.to_string())
+
+    write_otu_tables(
+        results,
+        taxon_df,
+        stats_path,
+        output_folder,
+        args.sparse_format,
+        args.min_breadth,
+        taxonomy,
+        args.lca_ranks,
+    )
+
 if __name__ == "__main__":
     main()
@@ -1,19 +1,366 @@
-import pandas as pd
-import numpy as np
-
-df = pd.read_csv("results/vsearch/amplicons_identity.tsv", sep="\t", header=None)
-df.columns = ["qseqid","sseqid","pident","length","mismatch","gapopen","qstart","qend","sstart","send","evalue","bitscore"]
-
-# Pivot
-matrix = df.pivot(index="qseqid", columns="sseqid", values="pident")
-
-# Sort columns by number of non-missing values (descending)
-col_order = matrix.notna().sum().sort_values(ascending=False).index
-matrix_sorted_cols = matrix[col_order]
-
-# Sort rows by number of non-missing values (descending)
-row_order = matrix_sorted_cols.notna().sum(axis=1).sort_values(ascending=False).index
-matrix_sorted = matrix_sorted_cols.loc[row_order]
-
-# Print
-matrix_sorted.to_csv("results/vsearch/amplicons_identity_matrix.csv")
\ No newline at end of file
+import pandas as pd
+import numpy as np
+from pathlib import Path
+import argparse
+from scipy import sparse
+
+
+BLAST6_COLUMNS = ["qseqid","sseqid","pident","length","mismatch","gapopen","qstart","qend","sstart","send","evalue","bitscore"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Pivot the vsearch all-vs-all identities (blast6out) into a query x subject identity matrix, "
+        "rows and columns sorted by their number of hits."
+    )
+    parser.add_argument(
+        "-i", "--input",
+        type=str,
+        default="results/vsearch/amplicons_identity.tsv",
+        help="vsearch blast6out table (default: results/vsearch/amplicons_identity.tsv)"
+    )
+    parser.add_argument(
+        "-o", "--output_prefix",
+        type=str,
+        default="results/vsearch/amplicons_identity_matrix",
+        help="Prefix of the output files (default: results/vsearch/amplicons_identity_matrix)"
+    )
+    parser.add_argument(
+        "--output_format",
+        choices=["long", "csv", "memmap"],
+        default="long",
+        help="long: sparse long table <prefix>_long.tsv (qseqid, sseqid, pident) in matrix order; "
+        "csv: dense matrix <prefix>.csv as before, written in row blocks; "
+        "memmap: dense float32 block <prefix>.npy (NaN = no hit, open with np.load(mmap_mode='r')) "
+        "with <prefix>_rows.tsv/<prefix>_cols.tsv (default: long)"
+    )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=1_000_000,
+        help="Number of hits read at once (default: 1000000)"
+    )
+    parser.add_argument(
+        "--block_rows",
+        type=int,
+        default=1000,
+        help="Number of matrix rows converted and written at once (default: 1000)"
+    )
+    parser.add_argument(
+        "--cluster",
+        nargs="+",
+        type=float,
+        default=None,
+        metavar="PIDENT",
+        help="Clustering mode instead of the pivot: single-linkage clusters of the sequences at every given "
+        "identity threshold (e.g. 97 98 99), written as <prefix>_clusters.tsv and <prefix>_representatives.tsv"
+    )
+    return parser.parse_args()
+
+
+def encode_names(names, name_codes):
+    """
+    Integer codes for a column of sequence IDs. name_codes maps ID -> code and is extended
+    with IDs not seen before, so codes stay stable across chunks.
+    """
+    local_codes, uniques = pd.factorize(names)
+    unique_codes = np.fromiter(
+        (name_codes.setdefault(name, len(name_codes)) for name in uniques),
+        dtype=np.int32,
+        count=len(uniques),
+    )
+    return unique_codes[local_codes]
+
+
+def read_identity_chunks(identity_file, chunksize=1_000_000):
+    """
+    Reads the query, subject and identity columns of a blast6out table in chunks.
+    """
+    return pd.read_csv(
+        identity_file,
+        sep="\t",
+        header=None,
+        names=BLAST6_COLUMNS,
+        usecols=["qseqid", "sseqid", "pident"],
+        dtype={"qseqid": str, "sseqid": str, "pident": np.float32},
+        chunksize=chunksize,
+    )
+
+
+def max_duplicates(rows, cols, values, n_cols):
+    """
+    Keeps one entry per (row, col) pair, the highest value if a pair was reported more than once.
+    """
+    pairs = rows.astype(np.int64) * n_cols + cols
+    order = np.argsort(pairs, kind="stable")
+    pairs = pairs[order]
+    starts = np.flatnonzero(np.r_[True, pairs[1:] != pairs[:-1]])
+    values = np.maximum.reduceat(values[order], starts) if len(pairs) else values
+    rows, cols = np.divmod(pairs[starts], n_cols)
+    return rows, cols, values
+
+
+def read_identity_matrix(identity_file, chunksize=1_000_000):
+    """
+    Streams the blast6out table into a sparse float32 query x subject matrix (CSR).
+    IDs are integer-coded while reading, only the codes and identities of the hits are kept.
+    """
+    query_codes = {}
+    subject_codes = {}
+    rows, cols, values = [], [], []
+
+    for chunk in read_identity_chunks(identity_file, chunksize):
+        rows.append(encode_names(chunk["qseqid"], query_codes))
+        cols.append(encode_names(chunk["sseqid"], subject_codes))
+        values.append(chunk["pident"].to_numpy(np.float32))
+
+    rows, cols, values = (np.concatenate(parts) for parts in (rows, cols, values))
+    rows, cols, values = max_duplicates(rows, cols, values, len(subject_codes))
+    matrix = sparse.csr_matrix(
+        (values, (rows, cols)), shape=(len(query_codes), len(subject_codes)), dtype=np.float32
+    )
+
+    return (
+        matrix,
+        np.array(list(query_codes), dtype=object),
+        np.array(list(subject_codes), dtype=object),
+    )
+
+
+def nnz_order(names, counts):
+    """
+    Positions sorted by number of hits (descending). Like the former dense pivot, IDs are
+    sorted alphabetically first, so ties come out in the same order as before.
+    """
+    by_name = np.argsort(names, kind="stable")
+    by_count = pd.Series(counts[by_name]).sort_values(ascending=False).index.to_numpy()
+    return by_name[by_count]
+
+
+def sort_matrix(matrix, row_names, col_names):
+    """
+    Sorts columns and then rows by their number of non-missing values, from the sparse
+    non-zero counts.
+    """
+    col_order = nnz_order(col_names, matrix.getnnz(axis=0))
+    matrix = matrix[:, col_order]
+    row_order = nnz_order(row_names, matrix.getnnz(axis=1))
+    matrix = matrix[row_order]
+    matrix.sort_indices()
+
+    return matrix, row_names[row_order], col_names[col_order]
+
+
+def dense_blocks(matrix, block_rows):
+    """
+    Yields (first row, dense float32 block) with NaN for pairs without a hit, block_rows rows at a time.
+    """
+    for start in range(0, matrix.shape[0], block_rows):
+        block = matrix[start : start + block_rows].tocoo()
+        dense = np.full((block.shape[0], matrix.shape[1]), np.nan, dtype=np.float32)
+        dense[block.row, block.col] = block.data
+        yield start, dense
+
+
+def write_long(matrix, row_names, col_names, out_file, block_rows):
+    """
+    Writes the hits as a long table (qseqid, sseqid, pident), rows and columns in matrix order.
+    """
+    with open(out_file, "w") as out:
+        out.write("qseqid\tsseqid\tpident\n")
+        for start in range(0, matrix.shape[0], block_rows):
+            block = matrix[start : start + block_rows].tocoo()
+            pd.DataFrame({
+                "qseqid": row_names[start + block.row],
+                "sseqid": col_names[block.col],
+                "pident": block.data,
+            }).to_csv(out, sep="\t", header=False, index=False)
+
+
+def write_csv(matrix, row_names, col_names, out_file, block_rows):
+    """
+    Writes the dense matrix as CSV (same layout as the former pivot), one block of rows at a time.
+    """
+    with open(out_file, "w") as out:
+        for start, dense in dense_blocks(matrix, block_rows):
+            block = pd.DataFrame(
+                dense,
+                index=pd.Index(row_names[start : start + len(dense)], name="qseqid"),
+                columns=col_names,
+            )
+            block.to_csv(out, header=start == 0)
+
+
+def write_memmap(matrix, row_names, col_names, prefix, block_rows):
+    """
+    Writes the dense matrix into a memory-mapped .npy file block by block, so it never has
+    to fit into memory, with the row and column IDs next to it.
+    """
+    dense_out = np.lib.format.open_memmap(
+        f"{prefix}.npy", mode="w+", dtype=np.float32, shape=matrix.shape
+    )
+    for start, dense in dense_blocks(matrix, block_rows):
+        dense_out[start : start + len(dense)] = dense
+    dense_out.flush()
+
+    pd.Series(row_names, name="qseqid").to_csv(f"{prefix}_rows.tsv", sep="\t", index=False)
+    pd.Series(col_names, name="sseqid").to_csv(f"{prefix}_cols.tsv", sep="\t", index=False)
+
+
+def find_root(parent, node):
+    """
+    Root of a node in the union-find forest, with path compression: every node on the way
+    is linked directly to the root.
+    """
+    root = node
+    while parent[root] != root:
+        root = parent[root]
+    while parent[node] != root:
+        parent[node], node = root, parent[node]
+    return root
+
+
+def union(parent, rank, a, b):
+    """
+    Merges the sets of a and b, the root of lower rank is attached below the other (union by rank).
+    """
+    a = find_root(parent, a)
+    b = find_root(parent, b)
+    if a == b:
+        return
+    if rank[a] < rank[b]:
+        a, b = b, a
+    parent[b] = a
+    if rank[a] == rank[b]:
+        rank[a] += 1
+
+
+def cluster_identities(identity_file, thresholds, chunksize=1_000_000):
+    """
+    Streams the hits once and keeps one union-find structure per identity threshold: a hit with
+    pident >= threshold joins the sets of both sequences. Also counts the hits per sequence
+    and threshold (used to pick representatives).
+    Returns the sequence IDs, the root per sequence and threshold and the hit counts.
+    """
+    seq_codes = {}
+    forests = [([], []) for _ in thresholds]
+    degrees = [np.zeros(0, dtype=np.int64) for _ in thresholds]
+
+    for chunk in read_identity_chunks(identity_file, chunksize):
+        queries = encode_names(chunk["qseqid"], seq_codes)
+        subjects = encode_names(chunk["sseqid"], seq_codes)
+        pident = chunk["pident"].to_numpy()
+        n_seqs = len(seq_codes)
+
+        for index, threshold in enumerate(thresholds):
+            parent, rank = forests[index]
+            parent.extend(range(len(parent), n_seqs))
+            rank.extend([0] * (n_seqs - len(rank)))
+
+            linked = pident >= threshold
+            for a, b in zip(queries[linked].tolist(), subjects[linked].tolist()):
+                union(parent, rank, a, b)
+
+            degree = np.bincount(
+                np.r_[queries[linked], subjects[linked]], minlength=n_seqs
+            )
+            degree[: len(degrees[index])] += degrees[index]
+            degrees[index] = degree
+
+    names = np.array(list(seq_codes), dtype=object)
+    roots = [
+        np.array([find_root(parent, node) for node in range(len(names))], dtype=np.int64)
+        for parent, _ in forests
+    ]
+    degrees = [np.r_[degree, np.zeros(len(names) - len(degree), dtype=np.int64)] for degree in degrees]
+
+    return names, roots, degrees
+
+
+def number_clusters(names, roots, degree, abundance):
+    """
+    Cluster numbers (1 = largest cluster, ties by representative ID) and the representative
+    of every cluster: its most abundant member (;size= annotation), then the one with most
+    hits above the threshold, then the first ID.
+    """
+    _, cluster, members = np.unique(roots, return_inverse=True, return_counts=True)
+    name_rank = np.argsort(np.argsort(names, kind="stable"), kind="stable")
+
+    order = np.lexsort((name_rank, -degree, -abundance, cluster))
+    first = order[np.r_[True, cluster[order][1:] != cluster[order][:-1]]]
+    representative = np.empty(len(members), dtype=np.int64)
+    representative[cluster[first]] = first
+
+    # Renumber clusters by size (descending), ties by the ID of the representative
+    cluster_order = np.lexsort((name_rank[representative], -members))
+    number = np.empty(len(members), dtype=np.int64)
+    number[cluster_order] = np.arange(1, len(members) + 1)
+
+    return number[cluster], representative[cluster_order], members[cluster_order]
+
+
+def write_clusters(names, roots, degrees, thresholds, prefix):
+    """
+    Writes the cluster of every sequence per threshold (<prefix>_clusters.tsv) and the
+    representative and size of every cluster per threshold (<prefix>_representatives.tsv).
+    """
+    abundance = (
+        pd.Series(names).str.extract(r";size=(\d+)", expand=False).astype(float).fillna(0).to_numpy()
+    )
+
+    memberships = pd.DataFrame({"seqid": names})
+    representatives = []
+    for threshold, threshold_roots, degree in zip(thresholds, roots, degrees):
+        number, representative, members = number_clusters(names, threshold_roots, degree, abundance)
+        memberships[f"cluster_{threshold:g}"] = number
+        representatives.append(pd.DataFrame({
+            "threshold": threshold,
+            "cluster": np.arange(1, len(members) + 1),
+            "representative": names[representative],
+            "members": members,
+        }))
+
+    cluster_columns = [f"cluster_{threshold:g}" for threshold in thresholds]
+    memberships.sort_values(cluster_columns + ["seqid"]).to_csv(
+        f"{prefix}_clusters.tsv", sep="\t", index=False
+    )
+    representatives = pd.concat(representatives, ignore_index=True)
+    representatives.to_csv(f"{prefix}_representatives.tsv", sep="\t", index=False)
+
+    summary = representatives.groupby("threshold")["cluster"].max()
+    print(f"{len(names)} sequences, clusters per threshold: {summary.to_dict()}")
+
+
+def main():
+    args = parse_args()
+    Path(args.output_prefix).parent.mkdir(parents=True, exist_ok=True)
+
+    # Clustering mode: union-find per threshold, no matrix
+    if args.cluster:
+        thresholds = sorted(set(args.cluster))
+        names, roots, degrees = cluster_identities(args.input, thresholds, args.chunksize)
+        write_clusters(names, roots, degrees, thresholds, args.output_prefix)
+        return
+
+    # Read into a sparse matrix
+    matrix, row_names, col_names = read_identity_matrix(args.input, args.chunksize)
+
+    # Sort columns, then rows, by number of non-missing values (descending)
+    matrix, row_names, col_names = sort_matrix(matrix, row_names, col_names)
+
+    # Print
+    if args.output_format == "long":
+        out_file = f"{args.output_prefix}_long.tsv"
+        write_long(matrix, row_names, col_names, out_file, args.block_rows)
+    elif args.output_format == "csv":
+        out_file = f"{args.output_prefix}.csv"
+        write_csv(matrix, row_names, col_names, out_file, args.block_rows)
+    else:
+        out_file = f"{args.output_prefix}.npy"
+        write_memmap(matrix, row_names, col_names, args.output_prefix, args.block_rows)
+
+    print(f"{matrix.shape[0]} x {matrix.shape[1]} matrix with {matrix.nnz} hits written to {out_file}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,38 +1,62 @@
 import pandas as pd
+import numpy as np
 import argparse
+from multiprocessing import Pool
 
-def is_overlap(hit1, hit2):
-    return not (hit1['protein_end'] < hit2['protein_start'] or hit1['protein_start'] > hit2['protein_end'])
+def select_hits(block):
+    # Greedy selection of non-overlapping hits on the sorted hits of a block of proteins.
+    # Hits come by start position, so a hit overlaps an accepted hit exactly if it starts at or before
+    # the furthest end of the accepted hits. Hits with start > end are checked against every accepted hit.
+    new_protein, starts, ends = block
+    keep = np.zeros(len(starts), dtype=bool)
 
-def filter_hits(input_file, output_file):
+    for i, (new, start, end) in enumerate(zip(new_protein.tolist(), starts.tolist(), ends.tolist())):
+        if new:
+            accepted = []
+            max_end = -np.inf
+
+        if start <= end:
+            overlap = start <= max_end
+        else:
+            overlap = any(not (hit_end < start or hit_start > end) for hit_start, hit_end in accepted)
+
+        if not overlap:
+            keep[i] = True
+            accepted.append((start, end))
+            if start <= end:
+                max_end = max(max_end, end)
+
+    return keep
+
+def filter_hits(input_file, output_file, threads=1):
     # Load the data into a pandas DataFrame
     columns = ["protein_id", "protein_length", "KO", "KO_length", "cEvalue", "protein_start", "protein_end", "hmm_from", "hmm_to", "protein_coverage", "hmm_coverage"]
     data = pd.read_csv(input_file, sep="\t", header=None, names=columns)
+    data = data.dropna(subset=["protein_id"])
 
     # Sort data by protein_id, protein_start, cEvalue, and protein_coverage
     data = data.sort_values(by=["protein_id", "protein_start", "cEvalue", "protein_coverage"], ascending=[True, True, True, False])
 
-    # Initialize an empty list to store the filtered results
-    filtered_hits = []
+    # First hit of every protein
+    protein_ids = data["protein_id"].to_numpy()
+    new_protein = np.ones(len(data), dtype=bool)
+    new_protein[1:] = protein_ids[1:] != protein_ids[:-1]
+
+    # Split the hits into blocks of whole proteins and process the blocks in parallel
+    protein_starts = np.flatnonzero(new_protein)
+    bounds = np.r_[protein_starts[::max(1, len(protein_starts) // (4 * threads))], len(data)]
 
-    # Process each protein_id separately
-    for protein_id, group in data.groupby('protein_id'):
-        non_overlapping_hits = []
+    starts = data["protein_start"].to_numpy()
+    ends = data["protein_end"].to_numpy()
+    blocks = [(new_protein[lo:hi], starts[lo:hi], ends[lo:hi]) for lo, hi in zip(bounds[:-1], bounds[1:])]
 
-        for _, hit in group.iterrows():
-            overlap = False
-            for existing_hit in non_overlapping_hits:
-                if is_overlap(hit, existing_hit):
-                    overlap = True
-                    break
-            
-            if not overlap:
-                non_overlapping_hits.append(hit)
-        
-        filtered_hits.extend(non_overlapping_hits)
+    if threads > 1 and len(blocks) > 1:
+        with Pool(threads) as pool:
+            keep = pool.map(select_hits, blocks)
+    else:
+        keep = [select_hits(block) for block in blocks]
 
-    # Convert the filtered hits back to a DataFrame
-    filtered_df = pd.DataFrame(filtered_hits, columns=columns)
+    filtered_df = data[np.concatenate(keep)] if keep else data
 
     # Save the results to the output file with a header
     filtered_df.to_csv(output_file, sep="\t", index=False)
@@ -41,8 +65,8 @@ if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Filter hits to find the most reasonable hit for each protein stretch.')
     parser.add_argument('-i', '--input', required=True, help='Input file path')
     parser.add_argument('-o', '--output', required=True, help='Output file path')
+    parser.add_argument('-t', '--threads', type=int, default=1, help='Number of processes, proteins are split into blocks that are filtered in parallel')
 
     args = parser.parse_args()
 
-    filter_hits(args.input, args.output)
-
+    filter_hits(args.input, args.output, args.threads)
@@ -0,0 +1,261 @@
+"""
+Title: Find CAZyme gene clusters (CGCs)
+Description: Finds CAZyme gene clusters, i.e. CAZymes next to transporters and/or transcription regulators on the same contig, from the parse_dbCAN.py output and lists of transporter and regulator proteins. Gene order comes from Prodigal-style protein names (<contig>_<gene number>) or a GFF. The signature genes of all contigs are sorted by contig and gene number once and split into clusters in a single pass wherever more than --distance other genes lie between two signature genes.
+Date: 2026-10-19
+Tags: CAZy, Protein_domains, Gene_clusters
+Usage: python find_dbCAN_CGC.py -i results/dbcan_detailed.tsv --transporters results/tcdb_hits.tsv --regulators results/tf_hits.tsv -o results/cgc
+"""
+
+import pandas as pd
+import numpy as np
+from pathlib import Path
+import argparse
+import sys
+
+
+# Signature gene types, a protein with more than one type keeps the first one
+SIGNATURE_TYPES = ["CAZyme", "TC", "TF"]
+GFF_COLUMNS = ["seqid", "source", "type", "start", "end", "score", "strand", "phase", "attributes"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Find CAZyme gene clusters (CAZymes near transporters and/or regulators) in dbCAN results."
+    )
+    parser.add_argument(
+        "-i",
+        "--input",
+        type=str,
+        required=True,
+        help="dbcan_detailed.tsv or dbcan_summary.tsv from parse_dbCAN.py (single or batch mode)",
+    )
+    parser.add_argument(
+        "--transporters",
+        type=str,
+        default=None,
+        help="Transporter (TC) proteins, protein IDs in the first column (e.g. diamond hits against TCDB). "
+        "With batch input (genome column) the genome is in the first and the protein ID in the second column",
+    )
+    parser.add_argument(
+        "--regulators",
+        type=str,
+        default=None,
+        help="Transcription regulator (TF) proteins, protein IDs in the first column. "
+        "With batch input (genome column) the genome is in the first and the protein ID in the second column",
+    )
+    parser.add_argument(
+        "--gff",
+        type=str,
+        default=None,
+        help="GFF with the CDS of the annotated proteins (default: gene order from Prodigal-style "
+        "protein names <contig>_<gene number>). With batch input (genome column) a TSV with the genome "
+        "and its GFF file per line",
+    )
+    parser.add_argument(
+        "-d",
+        "--distance",
+        type=int,
+        default=2,
+        help="Maximum number of other genes between two signature genes of a cluster (default: 2)",
+    )
+    parser.add_argument(
+        "-o",
+        "--output_prefix",
+        type=str,
+        required=True,
+        help="Prefix of the output tables <prefix>_clusters.tsv and <prefix>_genes.tsv",
+    )
+    return parser.parse_args()
+
+
+# ------------------------------- Signature genes ------------------------------- #
+def read_protein_list(path, with_genome=False):
+    """
+    Unique protein IDs from the first column of a file (one ID per line or a TSV), '#' lines are skipped.
+    With with_genome the genome is in the first and the protein ID in the second column.
+    """
+    columns = ["genome", "protein"] if with_genome else ["protein"]
+    proteins = pd.read_csv(path, sep="\t", header=None, comment="#", dtype=str)
+    if proteins.shape[1] < len(columns):
+        sys.exit(f"{path} needs the genome and protein ID in the first two columns for batch input. Exiting.")
+    proteins = proteins.iloc[:, : len(columns)].set_axis(columns, axis=1)
+    proteins = proteins.apply(lambda col: col.str.strip()).dropna()
+    return proteins.drop_duplicates().reset_index(drop=True)
+
+
+def read_cazymes(dbcan_file):
+    """
+    One row per CAZyme protein with its dbCAN families (hmm_id, joined by " | "). Proteins are
+    kept apart per genome if the table comes from the parse_dbCAN.py batch mode.
+    """
+    hits = pd.read_csv(dbcan_file, sep="\t", dtype=str)
+    keys = [col for col in ["genome", "seq_name"] if col in hits.columns]
+    hits = hits[keys + ["hmm_id"]].drop_duplicates()
+
+    cazymes = hits.groupby(keys, sort=False)["hmm_id"].agg(" | ".join)
+    return cazymes.rename("annotation").reset_index().rename(columns={"seq_name": "protein"})
+
+
+def signature_genes(cazymes, transporters=None, regulators=None):
+    """
+    Table of all signature genes (genome, protein, type, annotation).
+    """
+    genes = [cazymes.assign(type="CAZyme")]
+    for gene_type, proteins in [("TC", transporters), ("TF", regulators)]:
+        if proteins is not None:
+            genes.append(proteins.assign(type=gene_type))
+
+    genes = pd.concat(genes, ignore_index=True)
+    genes["type"] = pd.Categorical(genes["type"], categories=SIGNATURE_TYPES)
+    keys = [col for col in ["genome", "protein"] if col in genes.columns]
+    return genes.drop_duplicates(keys, keep="first").reset_index(drop=True)
+
+
+# -------------------------------- Gene positions -------------------------------- #
+def prodigal_positions(proteins):
+    """
+    Contig and gene number from Prodigal protein names (<contig>_<gene number>), NaN for other names.
+    """
+    parts = proteins.str.extract(r"^(.*)_(\d+)$")
+    return pd.DataFrame(
+        {"protein": proteins.to_numpy(), "contig": parts[0].to_numpy(), "gene": pd.to_numeric(parts[1]).to_numpy()}
+    )
+
+
+def gff_positions(gff_file):
+    """
+    Contig, gene number and coordinates of every CDS in a GFF. Genes are numbered by start position per contig.
+    The protein name is the ID attribute, Prodigal IDs (<contig number>_<gene number>) are renamed to the
+    protein names Prodigal writes to the .faa (<contig>_<gene number>).
+    """
+    gff = pd.read_csv(gff_file, sep="\t", comment="#", header=None, names=GFF_COLUMNS, dtype=str)
+    cds = gff[gff["type"] == "CDS"]
+
+    proteins = cds["attributes"].str.extract(r"(?:^|;)ID=([^;]+)")[0]
+    prodigal = proteins.str.fullmatch(r"\d+_\d+").fillna(False)
+    proteins = proteins.where(~prodigal, cds["seqid"] + "_" + proteins.str.split("_").str[1])
+
+    positions = pd.DataFrame(
+        {
+            "protein": proteins.to_numpy(),
+            "contig": cds["seqid"].to_numpy(),
+            "start": cds["start"].astype(np.int64).to_numpy(),
+            "end": cds["end"].astype(np.int64).to_numpy(),
+        }
+    )
+    positions = positions.sort_values(["contig", "start", "end"], kind="stable").reset_index(drop=True)
+    positions["gene"] = positions.groupby("contig", sort=False).cumcount() + 1
+    return positions.dropna(subset=["protein"]).drop_duplicates("protein")
+
+
+def gff_manifest_positions(manifest):
+    """
+    Gene positions of several genomes, from a TSV with the genome name and its GFF file per line.
+    """
+    gffs = pd.read_csv(manifest, sep="\t", header=None, usecols=[0, 1], names=["genome", "gff"], comment="#", dtype=str)
+    positions = [gff_positions(gff).assign(genome=genome) for genome, gff in zip(gffs["genome"], gffs["gff"])]
+    return pd.concat(positions, ignore_index=True)
+
+
+# ---------------------------------- Clustering ---------------------------------- #
+def find_clusters(genes, distance=2):
+    """
+    Sorts the signature genes by (genome,) contig and gene number and starts a new cluster at every
+    genome or contig change or where more than distance genes lie between two neighbouring signature genes.
+    Only clusters with a CAZyme and a transporter or regulator are kept. Returns the genes with their
+    cluster number.
+    """
+    keys = [col for col in ["genome", "contig"] if col in genes.columns]
+    genes = genes.sort_values(keys + ["gene"], kind="stable").reset_index(drop=True)
+    gene = genes["gene"].to_numpy()
+
+    new_cluster = np.ones(len(genes), dtype=bool)
+    new_cluster[1:] = np.diff(gene) > distance + 1
+    for key in keys:
+        values = genes[key].to_numpy()
+        new_cluster[1:] |= values[1:] != values[:-1]
+    cluster = np.cumsum(new_cluster) - 1
+
+    # Signature gene counts per cluster
+    n_clusters = cluster[-1] + 1 if len(genes) else 0
+    codes = genes["type"].cat.codes.to_numpy()
+    counts = np.zeros((n_clusters, len(SIGNATURE_TYPES)), dtype=np.int64)
+    np.add.at(counts, (cluster, codes), 1)
+    valid = (counts[:, 0] > 0) & (counts[:, 1:].sum(axis=1) > 0)
+
+    genes["cluster"] = cluster
+    return genes[valid[cluster]].reset_index(drop=True)
+
+
+def summarize_clusters(genes):
+    """
+    One row per cluster with its contig, gene range, signature gene counts and CAZyme families.
+    Clusters are named <contig>|CGC<number> (<genome>|<contig>|CGC<number> for batch input),
+    numbered along each contig.
+    """
+    grouped = genes.groupby("cluster", sort=True)
+    clusters = grouped.agg(contig=("contig", "first"), first_gene=("gene", "min"), last_gene=("gene", "max"))
+    if "start" in genes.columns:
+        clusters["start"] = grouped["start"].min()
+        clusters["end"] = grouped["end"].max()
+    if "genome" in genes.columns:
+        clusters.insert(0, "genome", grouped["genome"].first())
+
+    clusters["n_genes"] = clusters["last_gene"] - clusters["first_gene"] + 1
+    counts = pd.crosstab(genes["cluster"], genes["type"], dropna=False)
+    for gene_type in SIGNATURE_TYPES:
+        clusters[f"n_{gene_type}"] = counts[gene_type]
+    cazymes = genes[genes["type"] == "CAZyme"]
+    clusters["cazymes"] = cazymes.groupby("cluster", sort=True)["annotation"].agg(" | ".join)
+
+    keys = [col for col in ["genome", "contig"] if col in clusters.columns]
+    number = clusters.groupby(keys, sort=False).cumcount() + 1
+    clusters.insert(0, "cgc_id", clusters[keys].agg("|".join, axis=1) + "|CGC" + number.astype(str))
+    return clusters
+
+
+def main():
+    args = parse_args()
+    if not (args.transporters or args.regulators):
+        sys.exit("Clusters need transporters and/or regulators next to the CAZymes, give --transporters and/or --regulators. Exiting.")
+
+    # Signature genes
+    cazymes = read_cazymes(args.input)
+    batch = "genome" in cazymes.columns
+    transporters = read_protein_list(args.transporters, batch) if args.transporters else None
+    regulators = read_protein_list(args.regulators, batch) if args.regulators else None
+    genes = signature_genes(cazymes, transporters, regulators)
+    print(f"{len(genes)} signature genes: " + ", ".join(f"{n} {t}" for t, n in genes["type"].value_counts(sort=False).items()))
+
+    # Gene positions
+    keys = ["genome", "protein"] if batch else ["protein"]
+    if args.gff:
+        positions = gff_manifest_positions(args.gff) if batch else gff_positions(args.gff)
+        positions = positions.drop_duplicates(keys)
+    else:
+        positions = prodigal_positions(genes["protein"].drop_duplicates())
+        keys = ["protein"]
+    genes = genes.merge(positions, on=keys, how="left")
+    missing = genes["gene"].isna()
+    if missing.any():
+        print(f"{missing.sum()} signature genes without a position are skipped, e.g. {genes.loc[missing, 'protein'].iloc[0]}")
+    genes = genes[~missing].astype({col: np.int64 for col in ["gene", "start", "end"] if col in genes.columns})
+
+    # Clusters
+    cluster_genes = find_clusters(genes, args.distance)
+    clusters = summarize_clusters(cluster_genes)
+    # Genes with their cluster name
+    columns = [col for col in ["genome", "contig", "gene", "start", "end", "protein", "type", "annotation"] if col in genes.columns]
+    cluster_genes["cgc_id"] = cluster_genes["cluster"].map(clusters["cgc_id"])
+    cluster_genes = cluster_genes[["cgc_id"] + columns]
+
+    prefix = Path(args.output_prefix)
+    prefix.parent.mkdir(parents=True, exist_ok=True)
+    cluster_genes.to_csv(f"{prefix}_genes.tsv", sep="\t", index=False)
+    clusters.to_csv(f"{prefix}_clusters.tsv", sep="\t", index=False)
+
+    print(f"Finished! {len(clusters)} CGCs with {len(cluster_genes)} signature genes written to {prefix}_clusters.tsv and {prefix}_genes.tsv")
+
+
+if __name__ == "__main__":
+    main()
@@ -14,20 +14,38 @@
 # Last updated: 2025-02-11
 ###########################################################
 import pandas as pd
+import numpy as np
 import argparse
+import glob
 import os
+import sys
+from itertools import islice
+from multiprocessing import Pool
 
 
 def parse_arguments():
     """Parse command line arguments"""
     
-    parser = argparse.ArgumentParser(description="""Parse hmmsearch domtblout files against the dbCAN database to identify and annotate carbohydrate-active enzymes. \nFilters by E-value and coverage, removes overlapping domains, and provides both detailed and summary outputs. \nExample: python .\parse_dbCAN.py -i data/domain_results.txt -m data/fam-substrate-mapping-08262025.tsv -o results -e 1e-5 -c 0.30
+    parser = argparse.ArgumentParser(description="""Parse hmmsearch domtblout files against the dbCAN database to identify and annotate carbohydrate-active enzymes. \nFilters by E-value and coverage, removes overlapping domains, and provides both detailed and summary outputs. \nWith --manifest or --glob many genomes are parsed at once into combined tables with a genome column and a genome x CAZy family count matrix. \nExample: python .\parse_dbCAN.py -i data/domain_results.txt -m data/fam-substrate-mapping-08262025.tsv -o results -e 1e-5 -c 0.30
     """,
     formatter_class=argparse.RawTextHelpFormatter
     )
 
-    parser.add_argument(
-        "-i", "--input", required=True, help="Input hmmsearch domtblout file"
+    inputs = parser.add_mutually_exclusive_group(required=True)
+    inputs.add_argument(
+        "-i", "--input", help="Input hmmsearch domtblout file"
+    )
+
+    inputs.add_argument(
+        "--manifest",
+        help="Batch mode: TSV with one genome per line, genome name and domtblout file (or only the file,\n"
+        "then the file name without extension is used as genome name)",
+    )
+
+    inputs.add_argument(
+        "--glob",
+        help="Batch mode: quoted glob pattern of domtblout files, e.g. 'results/*_domain_results.txt',\n"
+        "the file name without extension is used as genome name",
     )
 
     parser.add_argument(
@@ -64,135 +82,235 @@ def parse_arguments():
         help="Overlap threshold for removing redundant hits (0-1)",
     )
 
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=1_000_000,
+        help="Number of domtblout lines read and filtered at a time",
+    )
+
+    parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=1,
+        help="Batch mode: number of genomes parsed in parallel",
+    )
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Print every sequence with more than one hit and the overlaps checked",
+    )
+
     return parser.parse_args()
 
 
+# Columns used from the hmmsearch domtblout: name, field position and Arrow type
+DOMTBLOUT_COLUMNS = [
+    ("seq_name", 0, "string"),
+    ("seq_len", 2, "int64"),
+    ("hmm", 3, "string"),
+    ("hmm_length", 5, "int64"),
+    ("i_evalue", 12, "float64"),
+    ("bitscore", 13, "float64"),
+    ("hmm_from", 15, "int64"),
+    ("hmm_to", 16, "int64"),
+    ("ali_from", 17, "int64"),
+    ("ali_to", 18, "int64"),
+]
+
+
+def read_domtblout_chunks(filename: str, chunksize: int = 1_000_000):
+    """
+    Yields the used domtblout columns as typed Arrow arrays, chunksize lines at a time.
+    Lines are only split on whitespace up to the last used field, so the free-text description stays intact.
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
+
+    maxsplit = max(position for _, position, _ in DOMTBLOUT_COLUMNS) + 1
+
+    with open(filename) as handle:
+        while True:
+            lines = list(islice(handle, chunksize))
+            if not lines:
+                break
+
+            # Skip comment and empty lines
+            lines = pc.utf8_rtrim_whitespace(pa.array(lines, pa.string()))
+            lines = lines.filter(
+                pc.and_(pc.invert(pc.starts_with(lines, "#")), pc.greater(pc.utf8_length(lines), 0))
+            )
+
+            fields = pc.utf8_split_whitespace(lines, max_splits=maxsplit)
+            yield {
+                name: pc.cast(pc.list_element(fields, position), pa.type_for_alias(dtype))
+                for name, position, dtype in DOMTBLOUT_COLUMNS
+            }
+
+
 def parse_domtblout(
-    filename: str, e_value_threshold: float = 1e-15, coverage_threshold: float = 0.35
+    filename: str,
+    e_value_threshold: float = 1e-15,
+    coverage_threshold: float = 0.35,
+    chunksize: int = 1_000_000,
 ) -> pd.DataFrame:
     """
     Read in and extract relevant columns from hmmsearch domtblout.
-    Pre-filters values with low E-value and coverage
+    Pre-filters values with low E-value and coverage chunk by chunk, so only passing hits are kept in memory
     """
-    df = pd.read_csv(
-        filename,
-        comment="#",
-        header=None,
-        usecols=[0, 2, 3, 5, 12, 13, 15, 16, 17, 18],
-        names=[
-            "seq_name",
-            "seq_len",
-            "hmm",
-            "hmm_length",
-            "i_evalue",
-            "bitscore",
-            "hmm_from",
-            "hmm_to",
-            "ali_from",
-            "ali_to",
-        ],
-        sep=r"\s+",
-    )
+    import pyarrow as pa
+
+    chunks = []
+    for columns in read_domtblout_chunks(filename, chunksize):
+        seq_len, i_evalue, ali_from, ali_to = (
+            columns[name].to_numpy() for name in ["seq_len", "i_evalue", "ali_from", "ali_to"]
+        )
+
+        # calculate coverage
+        coverage = (ali_to - ali_from) / seq_len
+
+        # remove 0 length alignments and filter low confidence hits
+        keep = (
+            (ali_from != ali_to)
+            & (i_evalue <= e_value_threshold)
+            & (coverage >= coverage_threshold)
+        )
+        chunk = pa.table(columns).filter(pa.array(keep)).to_pandas()
+        chunk["coverage"] = coverage[keep]
+        chunks.append(chunk)
+
+    # Empty file, same columns and types as a file without hits
+    if not chunks:
+        columns = {name: pa.array([], pa.type_for_alias(dtype)) for name, _, dtype in DOMTBLOUT_COLUMNS}
+        chunks.append(pa.table(columns).to_pandas().assign(coverage=np.empty(0, dtype=np.float64)))
+
+    df = pd.concat(chunks, ignore_index=True)
 
     # Clean hmm content
     df["hmm"] = df["hmm"].str.replace(r"\.hmm", "", regex=True)
     df["hmm_id"] = df["hmm"].str.replace(r"_.*", "", regex=True)
-    df['i_evalue_formatted'] = df['i_evalue'].apply(lambda x: f"{x:.2e}")
-    
-    # remove 0 length alignments
-    df = df[df["ali_from"] != df["ali_to"]]
 
-    # calculate coverage
-    df["coverage"] = (df["ali_to"] - df["ali_from"]) / df["seq_len"]
+    return df
 
-    # filter low confidence hits
-    df = df[
-        (df["i_evalue"] <= e_value_threshold) & (df["coverage"] >= coverage_threshold)
-    ]
 
-    return df
+def format_evalues(evalues: pd.Series) -> pd.Series:
+    """
+    E-values in scientific notation with two decimals, only done for the hits that are written out
+    """
+    return pd.Series(np.char.mod("%.2e", evalues.to_numpy(dtype=float)), index=evalues.index, dtype=object)
 
 
-def remove_overlaps(df: pd.DataFrame, overlap_threshold: float = 0.5) -> pd.DataFrame:
+def remove_overlaps(
+    df: pd.DataFrame, overlap_threshold: float = 0.5, verbose: bool = False
+) -> pd.DataFrame:
     """
     Takes the domtblout to identify and remove overlapping/redundant dbCAN domain hits on the same sequence.
+    Sweeps once over the sorted hits of every sequence on NumPy arrays.
     """
     # Group hits by sequence
     df = df.sort_values(["seq_name", "ali_from", "ali_to"])
 
-    # Remove if overlap exceeds the overlap_threshold, i.e. 50%, of either domain's length 
-    # and keep hit with better e-value
-    remove_indices = []
+    seq_names = df["seq_name"].to_numpy()
+    ali_from = df["ali_from"].to_numpy().tolist()
+    ali_to = df["ali_to"].to_numpy().tolist()
+    i_evalue = df["i_evalue"].to_numpy().tolist()
+    bitscore = df["bitscore"].to_numpy().tolist()
+    keep = np.ones(len(df), dtype=bool)
+
+    # Start and end of every sequence's block of hits
+    starts = np.flatnonzero(np.r_[True, seq_names[1:] != seq_names[:-1]])
+    ends = np.r_[starts[1:], len(df)]
+
+    # Remove if overlap exceeds the overlap_threshold, i.e. 50%, of either domain's length
+    # and keep hit with better e-value.
+    # Sequences with only one hit are skipped - nothing to compare
+    multi = ends - starts > 1
+    for start, end in zip(starts[multi].tolist(), ends[multi].tolist()):
+        if verbose:
+            print(seq_names[start], df.iloc[start:end])
+
+        # current is the last kept hit, each following hit is compared against it
+        current = start
+        for next_hit in range(start + 1, end):
+            current_len = ali_to[current] - ali_from[current]
+            next_len = ali_to[next_hit] - ali_from[next_hit]
+            overlap = ali_to[current] - ali_from[next_hit]
+            if verbose:
+                print(current_len, next_len, overlap, overlap / current_len)
 
-    # Group by seq and check groups with more than one index
-    for seq_name, group in df.groupby("seq_name"):
-        indices = group.index.tolist()
+            # Check if significant overlap exists
+            if overlap > 0 and (overlap / current_len > overlap_threshold or
+                    overlap / next_len > overlap_threshold):
+                # Remove the hit with worse (higher) E-value, bitscore as tiebreaker (higher is better)
+                if i_evalue[current] < i_evalue[next_hit] or (
+                    i_evalue[current] == i_evalue[next_hit]
+                    and bitscore[current] >= bitscore[next_hit]
+                ):
+                    keep[next_hit] = False
+                else:
+                    keep[current] = False
+                    current = next_hit
+            else:
+                current = next_hit
 
-        # Skip sequences with only one hit - nothing to compare
-        if len(indices) <= 1:
-            continue
-        print(seq_name, group)
+    # Remove marked hits and return
+    df = df[keep].reset_index(drop=True)
 
-        i = 0
-        while i < len(indices) - 1:
-            current_idx = indices[i]
-            next_idx = indices[i + 1]
+    return df
 
-            current = df.loc[current_idx]
-            next_hit = df.loc[next_idx]
 
-            # Calculate overlap
-            current_len = current["ali_to"] - current["ali_from"]
-            next_len = next_hit["ali_to"] - next_hit["ali_from"]
-            overlap = current["ali_to"] - next_hit["ali_from"]
-            print(current_len, next_len, overlap, overlap / current_len)
+def join_groups(keys: pd.Series, values: pd.Series, separator: str, unique: bool = True) -> pd.Series:
+    """
+    Joins the non-missing values of every group (in order of appearance) with separator, optionally only
+    unique values. Groups are sorted integer codes of the keys, the values of each group end up next to
+    each other and are joined in Arrow in one go. Groups without values get None
+    """
+    import pyarrow as pa
+    import pyarrow.compute as pc
 
-            # Check if significant overlap exists
-            if overlap > 0 and (overlap/current_len > overlap_threshold or 
-                    overlap/next_len > overlap_threshold):
-                # Remove the hit with worse (higher) E-value
-                if current['i_evalue'] < next_hit['i_evalue']:
-                    remove_indices.append(next_idx)
-                    indices.pop(i + 1)
-                elif current['i_evalue'] > next_hit['i_evalue']:
-                    remove_indices.append(current_idx)
-                    indices.pop(i)
-                else:  # E-values are equal, use bitscore as tiebreaker
-                    if current['bitscore'] >= next_hit['bitscore']:  # Higher is better
-                        remove_indices.append(next_idx)
-                        indices.pop(i + 1)
-                    else:
-                        remove_indices.append(current_idx)
-                        indices.pop(i)
-            else:
-                i += 1
+    codes, groups = pd.factorize(keys, sort=True)
+    values = pd.DataFrame({"code": codes, "value": values.to_numpy(dtype=object)})
+    values = values[(values["code"] >= 0) & values["value"].notna()]
+    if unique:
+        values = values.drop_duplicates()
 
-    # Remove marked indices and return
-    df = df.drop(remove_indices).reset_index(drop=True)
+    # Sort values by group, keeping their order within each group
+    values = values.sort_values("code", kind="stable")
+    counts = np.bincount(values["code"], minlength=len(groups))
+    offsets = pa.array(np.r_[0, np.cumsum(counts)], pa.int64())
+    lists = pa.LargeListArray.from_arrays(offsets, pa.array(values["value"].to_numpy(), pa.string()))
 
-    return df
+    joined = pc.binary_join(lists, separator).to_numpy(zero_copy_only=False)
+    joined[counts == 0] = None
+    return pd.Series(joined, index=pd.Index(groups, name=keys.name))
 
 
-def add_metadata(df: pd.DataFrame, metadata: str) -> pd.DataFrame:
+def load_metadata(metadata: str) -> pd.DataFrame:
     """
-    Adds dbCAN metadata to the filtered dbCAN hmmsearch results
+    Reads the dbCAN family-substrate mapping with one row per family
     """
     mapping = pd.read_csv(
         metadata, sep="\t", usecols=["Family", "Name", "_Substrate_curated"]
     )
 
     # If a family has more than one Name or substrate, condense into one column separated by semicolon
-    mapping = mapping.groupby("Family", as_index=False).agg(
+    mapping = pd.DataFrame(
         {
-            "Name": lambda x: (
-                "; ".join(x.dropna().unique()) if x.notna().any() else None
-            ),
-            "_Substrate_curated": lambda x: (
-                "; ".join(x.dropna().unique()) if x.notna().any() else None
-            ),
+            column: join_groups(mapping["Family"], mapping[column], "; ")
+            for column in ["Name", "_Substrate_curated"]
         }
-    )
+    ).reset_index()
+
+    return mapping
 
+
+def add_metadata(df: pd.DataFrame, mapping: pd.DataFrame) -> pd.DataFrame:
+    """
+    Adds dbCAN metadata (see load_metadata) to the filtered dbCAN hmmsearch results
+    """
     # Merge metadata with the results
     df = df.merge(mapping, left_on="hmm_id", right_on="Family", how="left")
 
@@ -200,6 +318,9 @@ def add_metadata(df: pd.DataFrame, metadata: str) -> pd.DataFrame:
     df["Name"] = df["Name"].fillna("unknown")
     df["_Substrate_curated"] = df["_Substrate_curated"].fillna("unknown")
 
+    # Format e-values for the output
+    df["i_evalue_formatted"] = format_evalues(df["i_evalue"])
+
     # Drop redundant Family column
     df = df.drop(columns=["Family"])
     df = df.drop(columns=["i_evalue"])
@@ -222,22 +343,133 @@ def condense_by_gene(df: pd.DataFrame) -> pd.DataFrame:
     # Select relevant columns
     df["ali_pos"] = df["ali_from"].astype(str) + "-" + df["ali_to"].astype(str)
 
-    # Condense seq_name
-    grouped = df.groupby(["seq_name"], as_index=False).agg(
+    # Condense seq_name, all domains are kept, positions, e-values and metadata only once
+    grouped = pd.DataFrame(
         {
-            "hmm_id": lambda x: " | ".join(x.dropna()) if x.notna().any() else None,
-            "i_evalue_formatted": lambda x: " | ".join(x.astype(str).dropna().unique()),
-            "ali_pos": lambda x: (
-                " | ".join(x.dropna().unique()) if x.notna().any() else None
-            ),
-            "Name": lambda x: " | ".join(x.dropna().unique()),
-            "_Substrate_curated": lambda x: " | ".join(x.dropna().unique()),
+            "hmm_id": join_groups(df["seq_name"], df["hmm_id"], " | ", unique=False),
+            "i_evalue_formatted": join_groups(df["seq_name"], df["i_evalue_formatted"].astype(str), " | "),
+            "ali_pos": join_groups(df["seq_name"], df["ali_pos"], " | "),
+            "Name": join_groups(df["seq_name"], df["Name"], " | "),
+            "_Substrate_curated": join_groups(df["seq_name"], df["_Substrate_curated"], " | "),
         }
-    )
+    ).reset_index()
 
     return grouped
 
 
+# --------------------------------- Batch mode --------------------------------- #
+def read_manifest(manifest: str) -> list:
+    """
+    Genome names and domtblout files from a manifest (genome<TAB>file, or only file per line)
+    """
+    genomes = []
+    with open(manifest) as handle:
+        for line in handle:
+            fields = line.rstrip("\n").split("\t")
+            if not fields[0] or fields[0].startswith("#"):
+                continue
+            if len(fields) == 1:
+                genomes.append((genome_name(fields[0]), fields[0]))
+            else:
+                genomes.append((fields[0], fields[1]))
+    return genomes
+
+
+def genome_name(filename: str) -> str:
+    """
+    Genome name from a file name, e.g. GCF_000970205.txt -> GCF_000970205
+    """
+    return os.path.splitext(os.path.basename(filename))[0]
+
+
+# Metadata and settings of the current (worker) process, set by init_batch
+BATCH_MAPPING = None
+BATCH_ARGS = None
+
+
+def init_batch(mapping: pd.DataFrame, args: argparse.Namespace):
+    """
+    Hands the metadata and settings to a worker process once, instead of with every genome
+    """
+    global BATCH_MAPPING, BATCH_ARGS
+    BATCH_MAPPING = mapping
+    BATCH_ARGS = args
+
+
+def parse_genome(genome: tuple) -> tuple:
+    """
+    Parses, filters and annotates the domtblout of one genome, returns the detailed and summary tables
+    with the genome name as first column
+    """
+    name, filename = genome
+    args = BATCH_ARGS
+    df = parse_domtblout(filename, args.evalue, args.coverage, args.chunksize)
+    df = remove_overlaps(df, args.overlap_threshold, args.verbose)
+    df_meta = add_metadata(df, BATCH_MAPPING)
+    df_condensed = condense_by_gene(df_meta.copy())
+
+    df_meta.insert(0, "genome", name)
+    df_condensed.insert(0, "genome", name)
+    return df_meta, df_condensed
+
+
+def run_batch(genomes: list, mapping: pd.DataFrame, args: argparse.Namespace):
+    """
+    Parses all genomes in a process pool and appends them to the combined detailed and summary tables
+    as they finish, then writes the genome x CAZy family count matrix (number of domains per family)
+    """
+    detailed_output = os.path.join(args.outdir, "dbcan_detailed.tsv")
+    summary_output = os.path.join(args.outdir, "dbcan_summary.tsv")
+    counts_output = os.path.join(args.outdir, "dbcan_family_counts.tsv")
+
+    counts = []
+    pool = Pool(args.threads, initializer=init_batch, initargs=(mapping, args))
+    with pool, open(detailed_output, "w") as detailed, open(summary_output, "w") as summary:
+        for i, (df_meta, df_condensed) in enumerate(pool.imap(parse_genome, genomes)):
+            name = genomes[i][0]
+            df_meta.to_csv(detailed, sep="\t", index=False, header=i == 0)
+            df_condensed.to_csv(summary, sep="\t", index=False, header=i == 0)
+            counts.append(df_meta["hmm_id"].value_counts().rename(name))
+            print(f"  {name}: {len(df_meta)} domains in {len(df_condensed)} sequences")
+
+    # Genomes as rows, families as columns, genomes without hits are kept with zeros
+    matrix = pd.concat(counts, axis=1).T.fillna(0).astype(int)
+    matrix = matrix.reindex(columns=sorted(matrix.columns))
+    matrix = matrix.rename_axis(index="genome", columns=None)
+    matrix.to_csv(counts_output, sep="\t")
+
+    print(f"  Detailed results saved to {detailed_output}")
+    print(f"  Summary results saved to {summary_output}")
+    print(f"  Family counts saved to {counts_output}")
+
+
+def main_batch(args: argparse.Namespace):
+    if args.manifest:
+        genomes = read_manifest(args.manifest)
+    else:
+        genomes = [(genome_name(f), f) for f in sorted(glob.glob(args.glob, recursive=True))]
+
+    if not genomes:
+        sys.exit("No domtblout files found. Exiting.")
+    missing = [f for _, f in genomes if not os.path.isfile(f)]
+    if missing:
+        sys.exit(f"{len(missing)} domtblout files not found, e.g. {missing[0]}. Exiting.")
+    names = pd.Series([name for name, _ in genomes])
+    if names.duplicated().any():
+        sys.exit(
+            f"Genome names are not unique, e.g. {names[names.duplicated()].iloc[0]}. "
+            "Give every file a unique genome name in a manifest. Exiting."
+        )
+
+    # Metadata is read once and shared by all genomes
+    mapping = load_metadata(args.metadata)
+
+    print(f"Parsing {len(genomes)} genomes with {args.threads} processes...")
+    run_batch(genomes, mapping, args)
+
+    print(f"\nDone! Parsed {len(genomes)} genomes")
+
+
 def main():
     # Arguments
     # metadata_path = "data/fam-substrate-mapping-08262025.tsv"
@@ -250,19 +482,23 @@ def main():
     # Ensure output dir exists
     os.makedirs(args.outdir, exist_ok=True)
 
+    if not args.input:
+        main_batch(args)
+        return
+
     # Parsing
     print(f"Parsing {args.input}...")
-    df = parse_domtblout(args.input, args.evalue, args.coverage)
+    df = parse_domtblout(args.input, args.evalue, args.coverage, args.chunksize)
     print(f"  Found {len(df)} hits passing E-value and coverage filters")
 
     # Remove overlapping hits
     print("Removing overlapping hits...")
-    df_filt = remove_overlaps(df, args.overlap_threshold)
+    df_filt = remove_overlaps(df, args.overlap_threshold, args.verbose)
     print(f"  {len(df_filt)} hits remaining after overlap removal")
 
     # Add metadata
     print("Adding metadata...")
-    df_meta = add_metadata(df_filt, args.metadata)
+    df_meta = add_metadata(df_filt, load_metadata(args.metadata))
 
     # Save detailed results
     detailed_output = os.path.join(args.outdir, "dbcan_detailed.tsv")